@@ -15,9 +15,18 @@
 """
 
 
-from util import init_logger, conf, MQTTClient, handle_sigterm, delay_start, Router
-from switchbot import Discovery, Command
+from util import init_logger, get_logger, conf, MQTTClient, handle_sigterm, delay_start, Router, CommandQueue, HTTPAPI, \
+    RefreshCoordinator
+from util.adv_ingest import AdvertisementIngest
+from util.bluez_mirror import attach_ingest
+from util.diagnostics import ResourceSampler
+from switchbot import Discovery, Command, ShardCoordinator, KeepWarm, StatusRefresh
+from switchbot.models import decode_advertisement
 import signal
+import tracemalloc
+
+
+logger = get_logger("dc")
 
 
 if __name__ == '__main__':
@@ -26,14 +35,54 @@ if __name__ == '__main__':
     if conf.StartDelay.enabled:
         delay_start(conf.StartDelay.min, conf.StartDelay.max)
     init_logger(conf.Logger.level)
+    if conf.Diagnostics.enabled:
+        tracemalloc.start(conf.Diagnostics.tracemalloc_frames)
+        ResourceSampler().start()
     try:
         mqtt_client = MQTTClient()
-        discovery = Discovery(mqtt_client=mqtt_client)
-        command = Command(mqtt_client=mqtt_client)
-        router = Router(refresh_callback=discovery.publish_devices, command_callback=command.handle_command)
-        mqtt_client.on_connect = discovery.publish_devices
-        mqtt_client.on_message = router.route
-        discovery.start()
-        mqtt_client.start()
+        if conf.Shard.workers > 0:
+            command = Command(mqtt_client=mqtt_client)
+            coordinator = ShardCoordinator(mqtt_client=mqtt_client, reject_callback=command.reject_command)
+            refresh = RefreshCoordinator(refresh_callback=coordinator.refresh)
+            router = Router(refresh_callback=refresh.trigger, command_callback=coordinator.dispatch,
+                            reject_callback=command.reject_command, services=command.command_handlers.keys())
+            coordinator.on_device_online = router.add_device
+            coordinator.on_device_offline = router.remove_device
+            mqtt_client.on_connect = refresh.trigger
+            mqtt_client.on_message = router.route
+            refresh.start()
+            if conf.HTTP.enabled:
+                logger.warning("local HTTP API is not available in sharded mode")
+            coordinator.start()
+            mqtt_client.start()
+        else:
+            discovery = Discovery(mqtt_client=mqtt_client)
+            command = Command(mqtt_client=mqtt_client)
+            command_queue = CommandQueue(command_callback=command.handle_command, reject_callback=command.reject_command)
+            refresh = RefreshCoordinator(refresh_callback=discovery.publish_devices)
+            router = Router(refresh_callback=refresh.trigger, command_callback=command_queue.put,
+                            reject_callback=command.reject_command, services=command.command_handlers.keys())
+            discovery.on_device_online = router.add_device
+            discovery.on_device_offline = router.remove_device
+            mqtt_client.on_connect = refresh.trigger
+            mqtt_client.on_message = router.route
+            refresh.start()
+            discovery.start()
+            command_queue.start()
+            if conf.KeepWarm.enabled:
+                command.keep_warm = KeepWarm(session_factory=command.session_factory,
+                                             select_adapter=command.scheduler.select_adapter)
+                command.keep_warm.start()
+            if conf.Status.refresh_seconds > 0:
+                StatusRefresh(devices_callback=discovery.macs, refresh_callback=command.refresh_status).start()
+            if conf.Ingest.enabled:
+                ingest = AdvertisementIngest(decoder=decode_advertisement)
+                ingest.add_consumer(discovery.on_advertisements)
+                ingest.add_consumer(command.on_advertisements)
+                attach_ingest(ingest)
+                ingest.start()
+            if conf.HTTP.enabled:
+                HTTPAPI(registry_callback=discovery.registry, command_callback=command_queue.put).start()
+            mqtt_client.start()
     finally:
         pass
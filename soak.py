@@ -0,0 +1,176 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+
+from util import init_logger, get_logger, conf, handle_sigterm, MQTTClient, CommandQueue, Router
+from util.connection_scheduler import ConnectionScheduler
+from util.diagnostics import ResourceSampler
+from switchbot import Discovery, Command
+import atexit
+import json
+import mgw_dc
+import paho.mqtt.client
+import queue
+import signal
+import sys
+import threading
+import tracemalloc
+import types
+import typing
+
+
+logger = get_logger("soak")
+
+
+# stands in for the paho client below MQTTClient, acknowledges publishes like a broker and delivers commands
+class SimulatedBroker:
+    def __init__(self):
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_publish = None
+        self.__connected = False
+        self.__mid = 0
+        self.__acknowledgements = queue.Queue()
+        self.__responses: typing.Dict[str, dict] = dict()
+        self.__condition = threading.Condition()
+
+    def will_set(self, **_):
+        pass
+
+    def max_inflight_messages_set(self, _: int):
+        pass
+
+    def enable_logger(self, _):
+        pass
+
+    def is_connected(self) -> bool:
+        return self.__connected
+
+    def connect(self, *_, **__):
+        self.__connected = True
+        self.on_connect(self, None, dict(), 0)
+
+    def loop_forever(self):
+        while True:
+            self.on_publish(self, None, self.__acknowledgements.get())
+
+    def __next_mid(self) -> int:
+        # paho wraps message ids the same way
+        self.__mid = self.__mid % 65535 + 1
+        return self.__mid
+
+    def subscribe(self, *_, **__):
+        return paho.mqtt.client.MQTT_ERR_SUCCESS, self.__next_mid()
+
+    def unsubscribe(self, *_, **__):
+        return paho.mqtt.client.MQTT_ERR_SUCCESS, self.__next_mid()
+
+    def publish(self, topic: str, payload: str = None, qos: int = 0, retain: bool = False):
+        mid = self.__next_mid()
+        try:
+            response = json.loads(payload)
+        except ValueError:
+            response = None
+        if isinstance(response, dict) and "command_id" in response:
+            with self.__condition:
+                self.__responses[response["command_id"]] = json.loads(response["data"])
+                self.__condition.notify_all()
+        if qos > 0:
+            self.__acknowledgements.put(mid)
+        return types.SimpleNamespace(rc=paho.mqtt.client.MQTT_ERR_SUCCESS, mid=mid)
+
+    def deliver(self, topic: str, payload: str):
+        self.on_message(self, None, types.SimpleNamespace(topic=topic, payload=payload.encode()))
+
+    def response(self, command_id: str, timeout_seconds: float) -> typing.Optional[dict]:
+        with self.__condition:
+            self.__condition.wait_for(lambda: command_id in self.__responses, timeout_seconds)
+            return self.__responses.pop(command_id, None)
+
+
+def command_payload(iteration: int) -> str:
+    if iteration % 2:
+        return json.dumps({"command_id": str(iteration), "data": ""})
+    return json.dumps({"command_id": str(iteration), "data": json.dumps({"target_position": iteration % 101})})
+
+
+if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    signal.signal(signal.SIGINT, handle_sigterm)
+    init_logger(conf.Logger.level)
+    tracemalloc.start(conf.Diagnostics.tracemalloc_frames)
+    macs = [mac.strip().lower() for mac in conf.Soak.macs.split(",") if mac.strip()]
+    # without a recorded trace to replay, BlueZ and the devices are simulated on a private bus
+    if not conf.Trace.replay_path:
+        from util.bluez_sim import SimulatedBlueZ
+        adapters = ConnectionScheduler().adapters
+        if conf.Discovery.adapter not in adapters:
+            adapters.append(conf.Discovery.adapter)
+        simulator = SimulatedBlueZ(adapters, macs)
+        atexit.register(simulator.stop)
+    broker = SimulatedBroker()
+    paho.mqtt.client.Client = lambda **_: broker
+    client = MQTTClient()
+    discovery = Discovery(mqtt_client=client)
+    command = Command(mqtt_client=client)
+    command_queue = CommandQueue(command_callback=command.handle_command, reject_callback=command.reject_command)
+    router = Router(refresh_callback=discovery.publish_devices, command_callback=command_queue.put,
+                    reject_callback=command.reject_command, services=command.command_handlers.keys())
+    discovery.on_device_online = router.add_device
+    discovery.on_device_offline = router.remove_device
+    client.on_connect = discovery.publish_devices
+    client.on_message = router.route
+    command_queue.start()
+    threading.Thread(target=client.start, name="mqtt", daemon=True).start()
+    sampler = ResourceSampler()
+    failures = []
+    for iteration in range(conf.Soak.iterations):
+        if iteration % conf.Soak.scan_every == 0:
+            discovery._refresh_devices()
+        mac = macs[iteration % len(macs)]
+        service = conf.Senergy.service_status if iteration % 2 else conf.Senergy.service_command
+        broker.deliver(mgw_dc.com.gen_command_topic(conf.Discovery.device_id_prefix + mac, service),
+                       command_payload(iteration))
+        result = broker.response(str(iteration), conf.Soak.response_timeout_seconds)
+        if result is None:
+            failures.append("no response to command {}".format(iteration))
+        elif "error" in result:
+            failures.append(result["error"])
+        if iteration >= conf.Soak.warmup_iterations and (iteration - conf.Soak.warmup_iterations) % conf.Soak.sample_every == 0:
+            sample = sampler.sample()
+            logger.info("iteration {}: rss={}KiB fds={} threads={} failures={}".format(
+                iteration, sample["rss_bytes"] // 1024, sample["fds"], sample["threads"], len(failures)
+            ))
+    sampler.sample()
+    growth = sampler.growth()
+    logger.info("growth after {} iterations: {}".format(conf.Soak.iterations, growth))
+    for allocator in sampler.last.get("allocators", ()):
+        logger.info("allocator {location}: {size_bytes}B ({growth_bytes:+}B)".format(**allocator))
+    failed = False
+    if len(failures) > conf.Soak.max_failures:
+        logger.error("{} commands failed, first: {}".format(len(failures), failures[0]))
+        failed = True
+    if growth["rss_bytes"] > conf.Soak.max_rss_growth_kib * 1024:
+        logger.error("rss grew by {}KiB".format(growth["rss_bytes"] // 1024))
+        failed = True
+    if growth["fds"] > conf.Soak.max_fd_growth:
+        logger.error("fd count grew by {}".format(growth["fds"]))
+        failed = True
+    if growth["threads"] > conf.Soak.max_thread_growth:
+        logger.error("thread count grew by {}".format(growth["threads"]))
+        failed = True
+    sys.exit(1 if failed else 0)
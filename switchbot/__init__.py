@@ -17,9 +17,17 @@
 
 from .command import *
 from .discovery import *
+from .shard import *
+from .keep_warm import *
+from .models import *
+from .status_refresh import *
 
 
 __all__ = (
     command.__all__,
-    discovery.__all__
+    discovery.__all__,
+    shard.__all__,
+    keep_warm.__all__,
+    models.__all__,
+    status_refresh.__all__,
 )
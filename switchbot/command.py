@@ -13,231 +13,327 @@
    See the License for the specific language governing permissions and
    limitations under the License.
 """
+import contextlib
+import functools
 import json
 import typing
 import time
-import gatt
 import mgw_dc
 
-from util import conf, get_logger, MQTTClient, init_logger
-from util.ble_device import BLEDevice
-from util.ble_manager import BLEDeviceManager
+from util import conf, get_logger, MQTTClient, init_logger, InvalidCommand, ERROR_REJECTED, ERROR_FAILED
+from util.ble_session import BLESession
+from util.ble_trace import replay_enabled, ReplaySession, TraceDivergence
+from util.adv_ingest import Advertisement
+from util.bluez_mirror import get_mirror
+from util.connection_scheduler import ConnectionScheduler, DeviceOutOfRange
+from util.work_scheduler import get_work_scheduler, INTERACTIVE, BACKGROUND
+from .keep_warm import KeepWarm
+from .models import DeviceModel, services, model_of, check_response, curtain_model
 
 logger = get_logger(__name__.split(".", 1)[-1])
 
 __all__ = ("Command",)
 
-curtain_handle = 16
-
-response_code_ok = 0x01
-response_codes = {
-    0x02: "ERROR",
-    0x03: "BUSY",
-    0x04: "Communication protocol version incompatible",
-    0x05: "Device does not support this Command",
-    0x06: "Device is low power",
-    0x0D: "This command is not supported in the current mode",
-    0x0E: "Disconnected from the device that needs to stay connected",
-}
-
-charging_codes = {
-    0: "not charging",
-    1: "adapter charging",
-    2: "solar panel charging",
-    3: "adapter connected & fully charged",
-    4: "solar panel connected & fully charged",
-    5: "solar panel connected, but not charging",
-    6: "hardware error",
-}
-
 
 class Command:
     def __init__(self, mqtt_client: MQTTClient):
         self.__mqtt_client = mqtt_client
-        self.command_result: bytearray = bytearray()
-        self.connection_ok = False
-        self.command_handlers = {
-            conf.Senergy.service_status: self.service_status,
-            conf.Senergy.service_command: self.service_set_position,
-        }
-        self.command_requests = 0
-        self.position_to = 101
+        # services of all enabled device models, dispatched by the model of the addressed device
+        self.command_handlers = {service: functools.partial(self.run_service, service) for service in services()}
         self.retry = 0
+        self.scheduler = ConnectionScheduler()
+        self.session_factory = ReplaySession if replay_enabled() else BLESession
+        self.keep_warm: typing.Optional[KeepWarm] = None
+        self.__advertised: typing.Dict[str, typing.Tuple[float, dict]] = dict()
+        self.__statuses: typing.Dict[str, typing.Tuple[float, dict]] = dict()
+
+    def on_advertisements(self, batch: typing.List[Advertisement]):
+        for mac, _, timestamp, fields in batch:
+            self.__advertised[mac] = (timestamp, fields)
+
+    # decoded service data, falls back to the last advertisement seen by the ingest pipeline or the mirror
+    def passive_fields(self, device_id: str, service_data: typing.Optional[bytes]) -> dict:
+        model = model_of(device_id)
+        if service_data is not None:
+            return model.decode_service_data(service_data)
+        timestamp, fields = self.__advertised.get(device_id, (0.0, None))
+        if fields is not None and time.time() - timestamp <= conf.Link.max_advertisement_age_seconds:
+            return dict(fields)
+        for adapter in self.scheduler.adapters:
+            service_data = get_mirror().get(self.scheduler.device_path(adapter, device_id), 'ServiceData')
+            if service_data and conf.Discovery.service_data_uuid in service_data:
+                return model.decode_service_data(bytes(service_data[conf.Discovery.service_data_uuid]))
+        raise RuntimeError("Missing service data")
 
     def reset_for_next_cmd(self):
-        self.command_requests = 0
-        self.command_result = bytearray()
-        self.connection_ok = False
-        self.position_to = 101
         self.retry = 0
 
-    def handle_command(self, prefixed_device_id: str, service: str, payload: typing.AnyStr):
+    def handle_command(self, prefixed_device_id: str, service: str, payload: typing.AnyStr,
+                       reply: typing.Optional[typing.Callable] = None):
         device_id = prefixed_device_id.removeprefix(conf.Discovery.device_id_prefix)
 
-        payload = json.loads(payload)
+        message = payload
+        payload = json.loads(message)
         command_id = payload["command_id"]
-        if len(payload["data"]) == 0:
-            payload = {}
-        else:
-            payload = json.loads(payload["data"])
-        if service not in self.command_handlers:
+        try:
+            payload = json.loads(payload["data"]) if len(payload["data"]) else {}
+        except ValueError:
+            self.reject_command(prefixed_device_id, service, message, "invalid command data", reply=reply)
+            return
+        model = model_of(device_id)
+        if service not in self.command_handlers or service not in model.services():
             logger.error("Unimplemented service " + service)
+            self.reject_command(prefixed_device_id, service, message, "unimplemented service " + service, reply=reply)
             return
         self.reset_for_next_cmd()
+        if self.keep_warm and model.connectable:
+            self.keep_warm.record_command(device_id)
         try:
             result = self.run_command(device_id, service, payload)
         except Exception as ex:
             logger.error("Command failed: {}".format(ex))
+            # the platform gets an error response rather than waiting for its timeout
+            self.reject_command(prefixed_device_id, service, message, str(ex), reply=reply,
+                                kind=ERROR_REJECTED if isinstance(ex, InvalidCommand) else ERROR_FAILED)
+            return
+        if reply:
+            reply(result, None)
             return
         response = {"command_id": command_id, "data": json.dumps(result).replace("'", "\"")}
         self.__mqtt_client.publish(mgw_dc.com.gen_response_topic(prefixed_device_id, service),
-                                   json.dumps(response).replace("'", "\""), 2)
+                                   json.dumps(response).replace("'", "\""), 2, msg_class="response")
+
+    def reject_command(self, prefixed_device_id: str, service: str, payload: typing.AnyStr, reason: str,
+                       reply: typing.Optional[typing.Callable] = None, kind: str = ERROR_REJECTED):
+        if reply:
+            reply(None, reason, kind)
+            return
+        command_id = json.loads(payload)["command_id"]
+        response = {"command_id": command_id, "data": json.dumps({"error": reason}).replace("'", "\"")}
+        self.__mqtt_client.publish(mgw_dc.com.gen_response_topic(prefixed_device_id, service),
+                                   json.dumps(response).replace("'", "\""), 2, msg_class="response")
 
     def run_command(self, device_id: str, service: str, payload: dict):
         try:
             result = self.command_handlers[service](device_id, payload)
+        except (DeviceOutOfRange, TraceDivergence, InvalidCommand) as ex:
+            logger.error("Command execution failed: {}".format(ex))
+            raise
         except Exception as ex:
             logger.error("Command execution failed: {}".format(ex))
             if self.retry < conf.Discovery.command_retries:
                 self.retry += 1
-                logger.info("Command retry #" + str(self.retry) + " in " + str(conf.Discovery.command_retry_wait_seconds) + " seconds")
+                logger.info("Command retry #" + str(self.retry) + " in " +
+                            str(conf.Discovery.command_retry_wait_seconds) + " seconds")
                 time.sleep(conf.Discovery.command_retry_wait_seconds)
                 return self.run_command(device_id, service, payload)
-            raise RuntimeError("Out of retries")
+            raise RuntimeError("Out of retries - {}".format(ex)) from ex
         return result
 
-    def service_status(self, device_id: str, _: None = None) -> dict:
-        manager = BLEDeviceManager(adapter_name=conf.Discovery.adapter)
-        device = BLEDevice(device_id, manager, self.service_status_ready_callback,
-                           self.service_status_notification_callback)
-        device.connect()
-        manager.run(conf.Discovery.connect_timeout_seconds + conf.Discovery.command_timeout_seconds)
-        if not self.connection_ok:
-            raise RuntimeError("Could not establish connection")
-        logger.debug("Result: " + self.command_result.hex())
-        logger.debug("Manufacturer Data: " + json.dumps(device.get_manufacturer_data()))
-        service_data = device.get_service_data()[conf.Discovery.service_data_uuid]
-        logger.debug("Service Data: " + str(service_data))
-
-        if self.command_result[0] != response_code_ok:
-            raise RuntimeError(get_err_msg(self.command_result[0]))
-        result = {}
-
-        if service_data[0] == 99:
-            result['bluetooth_mode'] = 'advertising'
-        elif service_data[0] == 67:
-            result['bluetooth_mode'] = 'pair'
-        else:
-            result['bluetooth_mode'] = 'unknown: ' + str(service_data[0])
-
-        result['connection_allowed'] = service_data[1] >> 7 == 1
-        result['calibrated'] = (service_data[1] & 0b01000000) >> 6 == 1
-        result['battery'] = service_data[2] & 0b01111111
-        result['moving'] = service_data[3] >> 7 == 1
-        result['position'] = service_data[3] & 0b0111111
-        result['light_level'] = (service_data[4] & 0b11110000) >> 4
-        result['chain_length'] = service_data[4] & 0b00001111
-
-        result['firmware'] = self.command_result[2]
-        if self.command_result[4] >> 7 == 0:
-            result['direction'] = 'open to left'
-        else:
-            result['direction'] = 'open to right'
-        result['touch_and_go_enabled'] = (self.command_result[4] & 0b01000000) >> 6 == 1
-        result['lighting_effect_enabled'] = (self.command_result[4] & 0b00100000) >> 5 == 1
-        result['fault'] = (self.command_result[4] & 0b00001000) >> 3 == 1
-        result['solar_plugged_in'] = self.command_result[5] >> 7 == 1
-        result['number_timers'] = self.command_result[7]
-
-        self.command_result = self.command_result[8:]  # shift away previous response
-        if self.command_result[0] != response_code_ok:
-            raise RuntimeError(get_err_msg(self.command_result[0]))
-        result['delay_action'] = self.command_result[1] >> 7 == 1
-        result['number_light_actions'] = self.command_result[1] & 0b00001111
-        if (self.command_result[2] & 0b11110000) >> 4 == 0:
-            result['action_mode'] = 'performance'
-        elif (self.command_result[2] & 0b11110000) >> 4 == 1:
-            result['action_mode'] = 'silent'
-        else:
-            result['action_mode'] = 'invalid: ' + str((self.command_result[2] & 0b11110000) >> 4)
-
-        self.command_result = self.command_result[8:]  # shift away previous response
-        if self.command_result[0] != response_code_ok:
-            raise RuntimeError(get_err_msg(self.command_result[0]))
-        if self.command_result[3] in charging_codes:
-            result['charging_device_0'] = charging_codes[self.command_result[3]]
-        else:
-            result['charging_device_0'] = "unknown: " + str(self.command_result[3])
-
-        if self.command_result[6] in charging_codes:
-            result['charging_device_1'] = charging_codes[self.command_result[6]]
-        else:
-            result['charging_device_1'] = "unknown: " + str(self.command_result[6])
+    def run_service(self, service: str, device_id: str, payload: dict) -> dict:
+        if service == conf.Senergy.service_status:
+            return self.service_status(device_id)
+        if service == conf.Senergy.service_batch:
+            return self.service_batch(device_id, payload)
+        return self.service_action(device_id, service, payload)
+
+    @contextlib.contextmanager
+    def connection(self, device_id: str, priority: int = INTERACTIVE):
+        adapter = self.scheduler.select_adapter(device_id)
+        with get_work_scheduler(adapter).acquire(priority):
+            session = self.keep_warm.take(device_id) if self.keep_warm else None
+            if session is None:
+                session = self.session_factory(device_id, adapter)
+                started = time.monotonic()
+                try:
+                    session.connect(conf.Discovery.connect_timeout_seconds)
+                except Exception:
+                    session.close()
+                    raise
+                if self.keep_warm:
+                    self.keep_warm.record_connect(time.monotonic() - started)
+            try:
+                yield session
+            except Exception:
+                session.close()
+                if self.keep_warm:
+                    self.keep_warm.release(device_id, session)
+                raise
+            if self.keep_warm:
+                self.keep_warm.release(device_id, session)
+            else:
+                session.close()
+
+    def exchange(self, device_id: str, frames: typing.List[bytearray],
+                 priority: int = INTERACTIVE) -> typing.Tuple[typing.List[bytearray], typing.Optional[bytes]]:
+        with self.connection(device_id, priority) as session:
+            # command timeout is budgeted for a curtain status query, longer batches get proportionally more
+            responses = session.exchange(frames, conf.Discovery.command_timeout_seconds *
+                                         max(1.0, len(frames) / len(curtain_model.status_queries())))
+            service_data = read_service_data(session)
+        for response in responses:
+            logger.debug("Result: " + response.hex())
+        return responses, service_data
+
+    # status of a device at background priority, kept for status commands while it is fresh
+    def refresh_status(self, device_id: str):
+        if model_of(device_id).status_queries():
+            self.service_status(device_id, priority=BACKGROUND)
+
+    def __cached_status(self, device_id: str) -> typing.Optional[dict]:
+        if conf.Status.refresh_seconds <= 0:
+            return None
+        timestamp, result = self.__statuses.get(device_id, (0.0, None))
+        if result is None or time.time() - timestamp > conf.Status.cache_seconds:
+            return None
+        result = dict(result)
+        try:
+            result.update(self.passive_fields(device_id, None))
+        except Exception:
+            pass
+        return result
 
+    def service_status(self, device_id: str, _: None = None, priority: int = INTERACTIVE) -> dict:
+        if priority == INTERACTIVE:
+            cached = self.__cached_status(device_id)
+            if cached is not None:
+                return cached
+        result = dict()
+        missing = []
+        service_data = None
+        queries = model_of(device_id).status_queries()
+        # models without status queries are answered from their advertisements alone
+        if queries:
+            with self.connection(device_id, priority) as session:
+                pending = list(queries)
+                timed_out = False
+                # only failed sub-queries are repeated, on the same connection unless one timed out, a late
+                # response to it could otherwise answer the next query
+                for attempt in range(conf.Status.retries + 1):
+                    missing = []
+                    for name, frame, decoder in pending:
+                        if timed_out:
+                            session.close()
+                            session.connect(conf.Discovery.connect_timeout_seconds)
+                            timed_out = False
+                        try:
+                            response = session.exchange([frame], getattr(conf.Status, name + "_timeout_seconds"))[0]
+                        except TraceDivergence:
+                            raise
+                        except Exception as ex:
+                            logger.warning("Status query '{}' of {} timed out - {}".format(name, device_id, ex))
+                            missing.append((name, frame, decoder))
+                            timed_out = True
+                            continue
+                        logger.debug("Result: " + response.hex())
+                        try:
+                            result.update(decoder(response))
+                        except Exception as ex:
+                            logger.warning("Status query '{}' of {} failed - {}".format(name, device_id, ex))
+                            missing.append((name, frame, decoder))
+                    pending = missing
+                    if not pending:
+                        break
+                service_data = read_service_data(session)
+                if timed_out:
+                    session.close()
+        missing = [name for name, _, _ in missing]
+        try:
+            passive_fields = self.passive_fields(device_id, service_data)
+        except Exception as ex:
+            logger.warning("Status of {} without advertisement fields - {}".format(device_id, ex))
+            passive_fields = dict()
+            missing.insert(0, "advertisement")
+        result = dict(passive_fields, **result)
+        if not result:
+            raise RuntimeError("No status fields received")
+        if missing:
+            result["partial"] = True
+            result["missing"] = missing
+        elif queries:
+            self.__statuses[device_id] = (time.time(), result)
         logger.debug(json.dumps(result))
-
         return result
 
-    @staticmethod
-    def service_status_ready_callback(device: BLEDevice):
-        device.notify(conf.Discovery.service_uuid, conf.Discovery.receiving_char_uuid)
-        device.write(conf.Discovery.service_uuid, conf.Discovery.sending_char_uuid, bytearray(b'\x57\x02'))
-
-    def service_status_notification_callback(self, device: BLEDevice, _: gatt.Characteristic,
-                                             value: bytearray):
-        if self.command_requests == 0:
-            self.command_result = value[:8]
-            device.write(conf.Discovery.service_uuid, conf.Discovery.sending_char_uuid,
-                         bytearray(b'\x57\x0F\x46\x81\x01'))
-        elif self.command_requests == 1:
-            if not isinstance(self.command_result, bytearray):
-                self.command_result = bytearray(self.command_result)
-            self.command_result.extend(value[:8])
-            device.write(conf.Discovery.service_uuid, conf.Discovery.sending_char_uuid,
-                         bytearray(b'\x57\x0F\x46\x04\x02'))
-        else:
-            self.command_result.extend(value[:7])
-            self.connection_ok = True
-            device.disconnect()
-            device.manager.stop()
-
-        self.command_requests += 1
-
-    def service_set_position(self, device_id: str, payload: dict) -> dict:
-        if "target_position" not in payload:
-            raise RuntimeError("Missing input")
-        self.position_to = payload["target_position"]
-        manager = BLEDeviceManager(adapter_name=conf.Discovery.adapter)
-        device = BLEDevice(device_id, manager, self.service_set_position_ready_callback,
-                           self.service_set_position_notification_callback)
-        device.connect()
-        manager.run(conf.Discovery.connect_timeout_seconds + conf.Discovery.command_timeout_seconds)
-        if not self.connection_ok:
-            raise RuntimeError("Could not establish connection")
-        logger.debug("Result: " + self.command_result.hex())
-        if self.command_result[0] != response_code_ok:
-            raise RuntimeError(get_err_msg(self.command_result[0]))
+    def service_action(self, device_id: str, service: str, payload: dict) -> dict:
+        self.__statuses.pop(device_id, None)
+        frame = model_of(device_id).actions()[service](payload)
+        responses, _ = self.exchange(device_id, [frame])
+        check_response(responses[0])
         return {}
 
-    def service_set_position_ready_callback(self, device: BLEDevice):
-        device.notify(conf.Discovery.service_uuid, conf.Discovery.receiving_char_uuid)
-        payload = bytearray(b'\x57\x0F\x45\x01\x05\xFF')
-        payload.append(self.position_to)
-        device.write(conf.Discovery.service_uuid, conf.Discovery.sending_char_uuid, payload)
-
-    def service_set_position_notification_callback(self, device: BLEDevice, __: gatt.Characteristic,
-                                             value: bytearray):
-        self.connection_ok = True
-        self.command_result = value
-        device.disconnect()
-        device.manager.stop()
-
-
-def get_err_msg(code: int) -> str:
-    err_msg = "Code " + str(code) + ": "
-    if code in response_codes:
-        err_msg += response_codes[code]
-    return err_msg
+    def service_batch(self, device_id: str, payload: dict) -> dict:
+        if "operations" not in payload or not isinstance(payload["operations"], list):
+            raise InvalidCommand("Missing input")
+        self.__statuses.pop(device_id, None)
+        model = model_of(device_id)
+        frames = []
+        for operation in payload["operations"]:
+            frames.extend(batch_operation_frames(model, operation))
+        if not frames:
+            return {"results": []}
+        responses, service_data = self.exchange(device_id, frames)
+        results = []
+        for operation in payload["operations"]:
+            count = len(batch_operation_frames(model, operation))
+            try:
+                results.append(decode_batch_operation(model, operation, responses[:count],
+                                                      lambda: self.passive_fields(device_id, service_data)))
+            except Exception as ex:
+                results.append({"error": str(ex)})
+            responses = responses[count:]
+        return {"results": results}
+
+
+def read_service_data(session) -> typing.Optional[bytes]:
+    logger.debug("Manufacturer Data: " + json.dumps(session.device.get_manufacturer_data()))
+    service_data = session.device.get_service_data()
+    if service_data is not None:
+        service_data = service_data.get(conf.Discovery.service_data_uuid)
+    logger.debug("Service Data: " + str(service_data))
+    return service_data
+
+
+def decode_status(model: DeviceModel, responses: typing.List[bytearray], passive_fields: dict) -> dict:
+    result = dict(passive_fields)
+    for (_, _, decoder), response in zip(model.status_queries(), responses):
+        result.update(decoder(response))
+    return result
+
+
+def batch_operation_frames(model: DeviceModel, operation: dict) -> typing.List[bytearray]:
+    if not isinstance(operation, dict):
+        raise InvalidCommand("Invalid operation " + json.dumps(operation))
+    name = operation.get("operation")
+    if name == conf.Senergy.service_status:
+        return [frame for _, frame, _ in model.status_queries()]
+    if name in model.actions():
+        try:
+            return [model.actions()[name](operation)]
+        except InvalidCommand as ex:
+            raise InvalidCommand("{} for operation {}".format(ex, name))
+    if name == "raw":
+        if "frame" not in operation:
+            raise InvalidCommand("Missing input for operation " + name)
+        try:
+            frame = bytearray.fromhex(operation["frame"])
+        except (TypeError, ValueError):
+            frame = None
+        if not frame:
+            raise InvalidCommand("Invalid frame " + json.dumps(operation["frame"]))
+        return [frame]
+    raise InvalidCommand("Unknown operation " + str(name))
+
+
+def decode_batch_operation(model: DeviceModel, operation: dict, responses: typing.List[bytearray],
+                           passive_fields: typing.Callable[[], dict]) -> dict:
+    name = operation["operation"]
+    if name == conf.Senergy.service_status:
+        return decode_status(model, responses, passive_fields())
+    if name in model.actions():
+        check_response(responses[0])
+        return {}
+    return {"response": responses[0].hex()}
 
 
 if __name__ == "__main__":
@@ -258,7 +354,7 @@ if __name__ == "__main__":
     logger.info("Setting position to 0%")
     cmd.reset_for_next_cmd()
     try:
-        cmd.service_set_position(mac, {"target_position": 0})
+        cmd.service_action(mac, conf.Senergy.service_command, {"target_position": 0})
     except Exception as ex:
         logger.error(str(ex))
 
@@ -276,7 +372,7 @@ if __name__ == "__main__":
     logger.info("Setting position to 10%")
     cmd.reset_for_next_cmd()
     try:
-        cmd.service_set_position(mac, {"target_position": 10})
+        cmd.service_action(mac, conf.Senergy.service_command, {"target_position": 10})
     except Exception as ex:
         logger.error(str(ex))
 
@@ -288,4 +384,3 @@ if __name__ == "__main__":
         cmd.service_status(mac)
     except Exception as ex:
         logger.error(str(ex))
-
@@ -14,17 +14,20 @@
    limitations under the License.
 """
 
-import json
 import threading
 import time
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
-import mgw_dc
 from mgw_dc.dm import Device, device_state
 
-from util import get_logger, conf, MQTTClient, diff, to_dict, init_logger
+from util import get_logger, conf, MQTTClient, DevicePublisher, diff, to_dict, init_logger
 from util.ble_device import BLEDevice
 from util.ble_manager import BLEDeviceManager
+from util.adv_ingest import Advertisement
+from util.ble_trace import replay_enabled, ReplayManager
+from util.connection_scheduler import ConnectionScheduler
+from util.work_scheduler import get_work_scheduler, WorkScheduler, DISCOVERY
+from .models import DeviceModel, identify, model_of
 
 __all__ = ("Discovery",)
 logger = get_logger(__name__.split(".", 1)[-1])
@@ -35,36 +38,130 @@ class Discovery(threading.Thread):
         super().__init__(name="discovery", daemon=True)
         self._mqtt_client = mqtt_client
         self._devices: List[Device] = []
+        self._publisher = DevicePublisher(mqtt_client)
+        self._links: Dict[str, Tuple[Optional[int], Optional[float]]] = dict()
+        self._scheduler = ConnectionScheduler()
+        self._manager_factory = ReplayManager if replay_enabled() else BLEDeviceManager
         self._current_device_is_switchbot = False
+        self._refresh_requested = threading.Event()
+        self.on_device_online = None
+        self.on_device_offline = None
+        self.device_filter = None
 
     def get_ble_devices(self) -> List[Device]:
         logger.info("Starting scan")
         devices: List[Device] = []
 
-        manager = BLEDeviceManager(conf.Discovery.adapter, self.discovery_device_ready)
-        manager.start_discovery([conf.Discovery.service_uuid])
-        manager.run(conf.Discovery.scan_timeout_seconds)
+        scheduler = get_work_scheduler(conf.Discovery.adapter)
+        manager = self._manager_factory(conf.Discovery.adapter, self.discovery_device_ready)
+        self.scan(manager, scheduler)
         logger.info("Found {} bluetooth device(s)".format(len(manager.devices())))
 
+        links = dict()
+        known = dict()
+        unknown = dict()
+        models: Dict[str, Optional[DeviceModel]] = dict()
         for device in manager.devices():
+            if self.device_filter and not self.device_filter(device.mac_address):
+                continue
+            service_data = device.get_service_data()
+            if service_data and conf.Discovery.service_data_uuid in service_data:
+                # the model byte identifies the device without connecting, unsupported models are skipped
+                models[device.mac_address] = identify(device.mac_address,
+                                                      bytes(service_data[conf.Discovery.service_data_uuid]))
+                if models[device.mac_address] is None:
+                    continue
+            if self.is_device_id_known(conf.Discovery.device_id_prefix + device.mac_address):
+                known[device.mac_address] = device
+            else:
+                unknown[device.mac_address] = device
+        # probe strongest first, devices out of range are deferred to a later scan
+        probes = [unknown[mac] for mac in self._scheduler.order(unknown, conf.Discovery.adapter)]
+
+        for device in list(known.values()) + probes:
             device_id = conf.Discovery.device_id_prefix + device.mac_address
-            if self.is_device_id_known(device_id):
-                logger.info(
-                    "Found curtain switchbot with mac {} and alias {}".format(device.mac_address, device.alias() + "_" + device.mac_address))
-                devices.append(Device(id=device_id, name=device.alias() + "_" + device.mac_address,
-                                      type=conf.Senergy.dt_curtain, state=device_state.online))
+            links[device_id] = self._scheduler.link(device.mac_address, conf.Discovery.adapter)
+            model = models.get(device.mac_address)
+            if device.mac_address in known:
+                model = model or model_of(device.mac_address)
+                name = self.device_name(device)
+                logger.info("Found {} switchbot with mac {} and alias {} (rssi {})".format(
+                    model.name, device.mac_address, name, links[device_id][0]))
+                devices.append(Device(id=device_id, name=name,
+                                      type=model.device_type(), state=device_state.online))
+            elif model is not None and not model.connectable:
+                name = self.device_name(device)
+                logger.info("Found {} switchbot with mac {} and alias {} (rssi {})".format(
+                    model.name, device.mac_address, name, links[device_id][0]))
+                devices.append(Device(id=device_id, name=name,
+                                      type=model.device_type(), state=device_state.online))
             else:
                 self._current_device_is_switchbot = False
-                device.connect()
-                manager.run(conf.Discovery.connect_timeout_seconds)
+                with scheduler.acquire(DISCOVERY):
+                    device.connect()
+                    manager.run(conf.Discovery.connect_timeout_seconds)
                 if self._current_device_is_switchbot:
-                    logger.info(
-                        "Found curtain switchbot with mac {} and alias {}".format(device.mac_address, device.alias()))
-                    devices.append(Device(id=device_id, name=device.alias(),
-                                          type=conf.Senergy.dt_curtain, state=device_state.online))
+                    model = model or model_of(device.mac_address)
+                    if not model.enabled():
+                        continue
+                    name = self.device_name(device)
+                    logger.info("Found {} switchbot with mac {} and alias {} (rssi {})".format(
+                        model.name, device.mac_address, name, links[device_id][0]))
+                    devices.append(Device(id=device_id, name=name,
+                                          type=model.device_type(), state=device_state.online))
         logger.info("Scan completed, found {} switchbots".format(str(len(devices))))
+        self._links = links
         return devices
 
+    # the same in every scan, so that a device is not republished as changed
+    @staticmethod
+    def device_name(device: BLEDevice) -> str:
+        return str(device.alias()) + "_" + device.mac_address
+
+    def on_advertisements(self, batch: List[Advertisement]):
+        links = self._links
+        for mac, rssi, timestamp, _ in batch:
+            device_id = conf.Discovery.device_id_prefix + mac
+            if device_id in links:
+                links[device_id] = (rssi if rssi is not None else links[device_id][0], timestamp)
+
+    def macs(self) -> List[str]:
+        return [device.id.removeprefix(conf.Discovery.device_id_prefix) for device in self._devices]
+
+    def registry(self) -> List[dict]:
+        registry = []
+        for device in self._devices:
+            rssi, last_advertised = self._links.get(device.id, (None, None))
+            registry.append({"id": device.id, "name": device.name, "type": device.type, "state": device.state,
+                             "rssi": rssi, "last_advertised": last_advertised})
+        return registry
+
+    @staticmethod
+    def scan(manager: BLEDeviceManager, scheduler: WorkScheduler):
+        # higher priority work stops the scan, which resumes for the remaining time afterwards
+        remaining = conf.Discovery.scan_timeout_seconds
+        preempted = threading.Event()
+
+        def preempt():
+            preempted.set()
+            manager.stop()
+
+        while remaining > 0:
+            preempted.clear()
+            with scheduler.acquire(DISCOVERY, preempt=preempt):
+                if scheduler.should_yield(DISCOVERY):
+                    continue
+                started = time.monotonic()
+                manager.start_discovery([conf.Discovery.service_uuid])
+                # a preemption before the main loop runs, e.g. during start_discovery, has nothing to stop
+                if not preempted.is_set():
+                    manager.run(remaining)
+                manager.stop_discovery()
+                if not preempted.is_set():
+                    return
+                remaining -= time.monotonic() - started
+            logger.debug("Scan paused, resuming for {:.1f}s".format(remaining))
+
     def is_device_id_known(self, device_id: str):
         for d in self._devices:
             if d.id == device_id:
@@ -81,12 +178,9 @@ class Discovery(threading.Thread):
     def _handle_new_device(self, device: Device):
         try:
             logger.info("adding '{}'".format(device.id))
-            self._mqtt_client.subscribe(topic=mgw_dc.com.gen_command_topic(device.id), qos=1)
-            self._mqtt_client.publish(
-                topic=mgw_dc.dm.gen_device_topic(conf.Client.id),
-                payload=json.dumps(mgw_dc.dm.gen_set_device_msg(device)),
-                qos=1
-            )
+            if self.on_device_online:
+                self.on_device_online(device.id)
+            self._publisher.publish(device)
         except Exception as ex:
             logger.error("adding '{}' failed - {}".format(device.id, ex))
 
@@ -94,23 +188,17 @@ class Discovery(threading.Thread):
         device.state = device_state.offline
         try:
             logger.info("setting '{}' offline ...".format(device.id))
-            self._mqtt_client.publish(
-                topic=mgw_dc.dm.gen_device_topic(conf.Client.id),
-                payload=json.dumps(mgw_dc.dm.gen_set_device_msg(device)),
-                qos=1
-            )
-            self._mqtt_client.unsubscribe(topic=mgw_dc.com.gen_command_topic(device.id))
+            if self.on_device_offline:
+                self.on_device_offline(device.id)
+            self._publisher.publish(device)
+            self._publisher.forget(device.id)
         except Exception as ex:
             logger.error("removing '{}' failed - {}".format(device.id, ex))
 
-    def _handle_existing_device(self, device: Device):
+    def _handle_existing_device(self, device: Device, force: bool):
         try:
-            logger.info("updating '{}' ...".format(device.id))
-            self._mqtt_client.publish(
-                topic=mgw_dc.dm.gen_device_topic(conf.Client.id),
-                payload=json.dumps(mgw_dc.dm.gen_set_device_msg(device)),
-                qos=1
-            )
+            if self._publisher.publish(device, force):
+                logger.info("updated '{}'".format(device.id))
         except Exception as ex:
             logger.error("updating '{}' failed - {}".format(device.id, ex))
 
@@ -126,10 +214,15 @@ class Discovery(threading.Thread):
                     self._handle_new_device(ble_devices[device_id])
             if missing_devices:
                 for device_id in missing_devices:
+                    if self.device_filter and not self.device_filter(device_id.removeprefix(conf.Discovery.device_id_prefix)):
+                        logger.info("handing over '{}' to another shard".format(device_id))
+                        self._publisher.forget(device_id)
+                        continue
                     self._handle_missing_device(stored_devices[device_id])
             if existing_devices:
+                force = self._publisher.full_republish_due()
                 for device_id in existing_devices:
-                    self._handle_existing_device(stored_devices[device_id])
+                    self._handle_existing_device(ble_devices[device_id], force)
         except Exception as ex:
             logger.error("refreshing devices failed - {}".format(ex))
 
@@ -140,21 +233,20 @@ class Discovery(threading.Thread):
         last_ble_check = time.time()
         self._refresh_devices()
         while True:
-            if time.time() - last_ble_check > conf.Discovery.scan_delay:
+            if self._refresh_requested.is_set() or time.time() - last_ble_check > conf.Discovery.scan_delay:
+                self._refresh_requested.clear()
                 last_ble_check = time.time()
                 self._refresh_devices()
-            time.sleep(conf.Discovery.scan_delay / 100)  # at most 1 % too late
+            self._refresh_requested.wait(conf.Discovery.scan_delay / 100)  # at most 1 % too late
+
+    def trigger_refresh(self):
+        self._refresh_requested.set()
 
     def publish_devices(self):
-        for device in self._devices:
-            try:
-                self._mqtt_client.publish(
-                    topic=mgw_dc.dm.gen_device_topic(conf.Client.id),
-                    payload=json.dumps(mgw_dc.dm.gen_set_device_msg(device)),
-                    qos=1
-                )
-            except Exception as ex:
-                logger.error("setting device '{}' failed - {}".format(device.id, ex))
+        try:
+            self._publisher.publish_all()
+        except Exception as ex:
+            logger.error("setting devices failed - {}".format(ex))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,176 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import collections
+import threading
+import time
+import typing
+
+from util import get_logger, conf
+from util.diagnostics import register_metrics
+from util.work_scheduler import get_work_scheduler, BACKGROUND
+
+__all__ = ("KeepWarm",)
+logger = get_logger(__name__.split(".", 1)[-1])
+
+day_seconds = 86400
+
+
+def time_of_day(timestamp: float) -> float:
+    local = time.localtime(timestamp)
+    return local.tm_hour * 3600 + local.tm_min * 60 + local.tm_sec
+
+
+class KeepWarm(threading.Thread):
+    def __init__(self, session_factory: typing.Callable, select_adapter: typing.Callable):
+        super().__init__(name="keep-warm", daemon=True)
+        self.__session_factory = session_factory
+        self.__select_adapter = select_adapter
+        self.__history: typing.Dict[str, typing.Deque[float]] = dict()
+        self.__warm: typing.Dict[str, typing.Any] = dict()
+        self.__busy: typing.Set[str] = set()
+        self.__wanted: typing.Set[str] = set()
+        self.__lock = threading.Lock()
+        self.__stats = {"hits": 0, "misses": 0, "warmed": 0, "connects": 0, "connect_total": 0.0}
+        register_metrics("keep_warm", self.metrics)
+
+    def record_command(self, device_id: str):
+        with self.__lock:
+            self.__history.setdefault(
+                device_id, collections.deque(maxlen=conf.KeepWarm.history_size)
+            ).append(time.time())
+
+    def record_connect(self, seconds: float):
+        with self.__lock:
+            self.__stats["connects"] += 1
+            self.__stats["connect_total"] += seconds
+
+    # likelihood of a command within the horizon, from the same time of day on previous days and from the recent rate
+    def score(self, device_id: str, now: float) -> float:
+        with self.__lock:
+            history = list(self.__history.get(device_id, ()))
+        if not history:
+            return 0.0
+        horizon = conf.KeepWarm.horizon_seconds
+        start = time_of_day(now)
+        days = set()
+        for timestamp in history:
+            if now - timestamp < horizon:
+                continue
+            offset = (time_of_day(timestamp) - start) % day_seconds
+            if offset <= horizon:
+                days.add(int((now - timestamp) // day_seconds))
+        observed_days = max(1.0, min((now - history[0]) / day_seconds, conf.KeepWarm.history_days))
+        daily = len([day for day in days if day < conf.KeepWarm.history_days]) / observed_days
+        recent = len([timestamp for timestamp in history if now - timestamp < day_seconds])
+        return max(daily, recent * horizon / day_seconds)
+
+    def take(self, device_id: str):
+        with self.__lock:
+            session = self.__warm.pop(device_id, None)
+            if session is not None:
+                self.__busy.add(device_id)
+        if session is not None and not session.is_alive():
+            session.close()
+            with self.__lock:
+                self.__busy.discard(device_id)
+            session = None
+        with self.__lock:
+            if session is None:
+                self.__stats["misses"] += 1
+            else:
+                self.__stats["hits"] += 1
+        return session
+
+    def release(self, device_id: str, session):
+        with self.__lock:
+            self.__busy.discard(device_id)
+            if (session.connected and device_id in self.__wanted and device_id not in self.__warm
+                    and len(self.__warm) < conf.KeepWarm.max_connections):
+                self.__warm[device_id] = session
+                return
+        session.close()
+
+    def __cool(self, device_id: str):
+        with self.__lock:
+            session = self.__warm.pop(device_id, None)
+        if session is not None:
+            logger.debug("Releasing warm connection to " + device_id)
+            session.close()
+
+    def __warm_up(self, device_id: str):
+        try:
+            adapter = self.__select_adapter(device_id)
+            with get_work_scheduler(adapter).acquire(BACKGROUND):
+                session = self.__session_factory(device_id, adapter)
+                started = time.monotonic()
+                session.connect(conf.Discovery.connect_timeout_seconds)
+                self.record_connect(time.monotonic() - started)
+        except Exception as ex:
+            logger.debug("Could not warm up {} - {}".format(device_id, ex))
+            return
+        logger.debug("Holding warm connection to " + device_id)
+        with self.__lock:
+            self.__stats["warmed"] += 1
+        self.release(device_id, session)
+
+    def __update(self):
+        now = time.time()
+        with self.__lock:
+            devices = list(self.__history)
+            warm = list(self.__warm)
+        scores = sorted(((self.score(device_id, now), device_id) for device_id in devices), reverse=True)
+        wanted = [device_id for score, device_id in scores if score >= conf.KeepWarm.threshold]
+        wanted = wanted[:conf.KeepWarm.max_connections]
+        with self.__lock:
+            self.__wanted = set(wanted)
+        for device_id in warm:
+            if device_id not in wanted:
+                self.__cool(device_id)
+        for device_id in warm:
+            if device_id in wanted:
+                with self.__lock:
+                    session = self.__warm.get(device_id)
+                if session is not None and not session.is_alive():
+                    self.__cool(device_id)
+        for device_id in wanted:
+            with self.__lock:
+                skip = device_id in self.__warm or device_id in self.__busy
+            if not skip:
+                self.__warm_up(device_id)
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.__update()
+            except Exception as ex:
+                logger.error("keep warm update failed - {}".format(ex))
+            time.sleep(conf.KeepWarm.interval_seconds)
+
+    def metrics(self) -> dict:
+        with self.__lock:
+            stats = dict(self.__stats)
+            warm = len(self.__warm)
+        requests = stats["hits"] + stats["misses"]
+        connect_avg = stats["connect_total"] / stats["connects"] if stats["connects"] else 0.0
+        return {
+            "warm": warm,
+            "hits": stats["hits"],
+            "misses": stats["misses"],
+            "hit_rate": stats["hits"] / requests if requests else 0.0,
+            "connect_avg_seconds": connect_avg,
+            "latency_saved_seconds": stats["hits"] * connect_avg,
+        }
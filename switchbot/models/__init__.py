@@ -0,0 +1,31 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from .registry import *
+from .curtain import *
+from .bot import *
+from .meter import *
+from .contact import *
+
+
+# flat, the package is star-imported by switchbot
+__all__ = (
+    *registry.__all__,
+    *curtain.__all__,
+    *bot.__all__,
+    *meter.__all__,
+    *contact.__all__,
+)
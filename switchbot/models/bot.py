@@ -0,0 +1,76 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import typing
+
+from util import conf, InvalidCommand
+from .registry import DeviceModel, register_model, check_response
+
+__all__ = ("Bot",)
+
+press_frame = bytearray(b'\x57\x01\x00')
+on_frame = bytearray(b'\x57\x01\x01')
+off_frame = bytearray(b'\x57\x01\x02')
+
+
+def decode_service_data(service_data: bytes) -> dict:
+    switch_mode = service_data[1] >> 7 == 1
+    return {
+        'switch_mode': switch_mode,
+        'power': switch_mode and (service_data[1] & 0b01000000) >> 6 == 0,
+        'battery': service_data[2] & 0b01111111,
+    }
+
+
+def decode_device_info(response: bytearray) -> dict:
+    check_response(response)
+    return {
+        'battery': response[1],
+        'firmware': response[2] / 10.0,
+        'number_timers': response[8],
+        'dual_state_mode': (response[9] & 0b00010000) >> 4 == 1,
+        'inverse_direction': response[9] & 0b00000001 == 1,
+        'hold_seconds': response[10],
+    }
+
+
+def encode_press(_: dict) -> bytearray:
+    return press_frame
+
+
+def encode_power(payload: dict) -> bytearray:
+    if "power" not in payload:
+        raise InvalidCommand("Missing input")
+    return on_frame if payload["power"] else off_frame
+
+
+class Bot(DeviceModel):
+    name = "bot"
+    model_byte = ord('H')
+
+    def device_type(self) -> str:
+        return conf.Senergy.dt_bot
+
+    def status_queries(self):
+        return (("device_info", bytearray(b'\x57\x02'), decode_device_info),)
+
+    def actions(self) -> typing.Dict[str, typing.Callable[[dict], bytearray]]:
+        return {conf.Senergy.service_press: encode_press, conf.Senergy.service_power: encode_power}
+
+    def decode_service_data(self, service_data: bytes) -> dict:
+        return decode_service_data(service_data)
+
+
+register_model(Bot())
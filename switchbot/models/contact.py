@@ -0,0 +1,44 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+from util import conf
+from .registry import DeviceModel, register_model
+
+__all__ = ("Contact",)
+
+
+def decode_service_data(service_data: bytes) -> dict:
+    return {
+        'battery': service_data[2] & 0b01111111,
+        'motion_detected': (service_data[1] & 0b01000000) >> 6 == 1,
+        'contact_open': service_data[3] & 0b00000010 != 0,
+        'contact_timeout': service_data[3] & 0b00000110 == 0b00000110,
+        'light': service_data[3] & 0b00000001 == 1,
+    }
+
+
+class Contact(DeviceModel):
+    name = "contact"
+    model_byte = ord('d')
+    connectable = False
+
+    def device_type(self) -> str:
+        return conf.Senergy.dt_contact
+
+    def decode_service_data(self, service_data: bytes) -> dict:
+        return decode_service_data(service_data)
+
+
+register_model(Contact())
@@ -0,0 +1,137 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import json
+import typing
+
+from util import conf, InvalidCommand
+from .registry import DeviceModel, register_model, check_response
+
+__all__ = ("Curtain", "curtain_model", "set_position_frame", "decode_service_data", "decode_device_info",
+           "decode_extended_settings", "decode_charging")
+
+charging_codes = {
+    0: "not charging",
+    1: "adapter charging",
+    2: "solar panel charging",
+    3: "adapter connected & fully charged",
+    4: "solar panel connected & fully charged",
+    5: "solar panel connected, but not charging",
+    6: "hardware error",
+}
+
+
+def set_position_frame(position: int) -> bytearray:
+    frame = bytearray(b'\x57\x0F\x45\x01\x05\xFF')
+    frame.append(position)
+    return frame
+
+
+def decode_service_data(service_data: bytes) -> dict:
+    result = {}
+    if service_data[0] == 99:
+        result['bluetooth_mode'] = 'advertising'
+    elif service_data[0] == 67:
+        result['bluetooth_mode'] = 'pair'
+    else:
+        result['bluetooth_mode'] = 'unknown: ' + str(service_data[0])
+
+    result['connection_allowed'] = service_data[1] >> 7 == 1
+    result['calibrated'] = (service_data[1] & 0b01000000) >> 6 == 1
+    result['battery'] = service_data[2] & 0b01111111
+    result['moving'] = service_data[3] >> 7 == 1
+    result['position'] = service_data[3] & 0b0111111
+    result['light_level'] = (service_data[4] & 0b11110000) >> 4
+    result['chain_length'] = service_data[4] & 0b00001111
+    return result
+
+
+def decode_device_info(response: bytearray) -> dict:
+    check_response(response)
+    result = {'firmware': response[2]}
+    if response[4] >> 7 == 0:
+        result['direction'] = 'open to left'
+    else:
+        result['direction'] = 'open to right'
+    result['touch_and_go_enabled'] = (response[4] & 0b01000000) >> 6 == 1
+    result['lighting_effect_enabled'] = (response[4] & 0b00100000) >> 5 == 1
+    result['fault'] = (response[4] & 0b00001000) >> 3 == 1
+    result['solar_plugged_in'] = response[5] >> 7 == 1
+    result['number_timers'] = response[7]
+    return result
+
+
+def decode_extended_settings(response: bytearray) -> dict:
+    check_response(response)
+    result = {
+        'delay_action': response[1] >> 7 == 1,
+        'number_light_actions': response[1] & 0b00001111,
+    }
+    if (response[2] & 0b11110000) >> 4 == 0:
+        result['action_mode'] = 'performance'
+    elif (response[2] & 0b11110000) >> 4 == 1:
+        result['action_mode'] = 'silent'
+    else:
+        result['action_mode'] = 'invalid: ' + str((response[2] & 0b11110000) >> 4)
+    return result
+
+
+def decode_charging(response: bytearray) -> dict:
+    check_response(response)
+    result = {}
+    if response[3] in charging_codes:
+        result['charging_device_0'] = charging_codes[response[3]]
+    else:
+        result['charging_device_0'] = "unknown: " + str(response[3])
+
+    if response[6] in charging_codes:
+        result['charging_device_1'] = charging_codes[response[6]]
+    else:
+        result['charging_device_1'] = "unknown: " + str(response[6])
+    return result
+
+
+def encode_set_position(payload: dict) -> bytearray:
+    if "target_position" not in payload:
+        raise InvalidCommand("Missing input")
+    position = payload["target_position"]
+    if not isinstance(position, int) or isinstance(position, bool) or not 0 <= position <= 100:
+        raise InvalidCommand("Invalid target_position " + json.dumps(position))
+    return set_position_frame(position)
+
+
+class Curtain(DeviceModel):
+    name = "curtain"
+    model_byte = ord('c')
+
+    def device_type(self) -> str:
+        return conf.Senergy.dt_curtain
+
+    def status_queries(self):
+        return (
+            ("device_info", bytearray(b'\x57\x02'), decode_device_info),
+            ("extended_settings", bytearray(b'\x57\x0F\x46\x81\x01'), decode_extended_settings),
+            ("charging", bytearray(b'\x57\x0F\x46\x04\x02'), decode_charging),
+        )
+
+    def actions(self) -> typing.Dict[str, typing.Callable[[dict], bytearray]]:
+        return {conf.Senergy.service_command: encode_set_position}
+
+    def decode_service_data(self, service_data: bytes) -> dict:
+        return decode_service_data(service_data)
+
+
+curtain_model = Curtain()
+register_model(curtain_model)
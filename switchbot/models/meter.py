@@ -0,0 +1,44 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+from util import conf
+from .registry import DeviceModel, register_model
+
+__all__ = ("Meter",)
+
+
+def decode_service_data(service_data: bytes) -> dict:
+    sign = 1 if service_data[4] >> 7 == 1 else -1
+    return {
+        'battery': service_data[2] & 0b01111111,
+        'temperature': sign * ((service_data[4] & 0b01111111) + (service_data[3] & 0b00001111) / 10),
+        'humidity': service_data[5] & 0b01111111,
+        'fahrenheit': service_data[5] >> 7 == 1,
+    }
+
+
+class Meter(DeviceModel):
+    name = "meter"
+    model_byte = ord('T')
+    connectable = False
+
+    def device_type(self) -> str:
+        return conf.Senergy.dt_meter
+
+    def decode_service_data(self, service_data: bytes) -> dict:
+        return decode_service_data(service_data)
+
+
+register_model(Meter())
@@ -0,0 +1,137 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import abc
+import typing
+
+from util import conf
+
+__all__ = ("DeviceModel", "register_model", "enabled_models", "services", "identify", "model_of",
+           "decode_advertisement", "check_response", "get_err_msg")
+
+response_code_ok = 0x01
+response_codes = {
+    0x02: "ERROR",
+    0x03: "BUSY",
+    0x04: "Communication protocol version incompatible",
+    0x05: "Device does not support this Command",
+    0x06: "Device is low power",
+    0x0D: "This command is not supported in the current mode",
+    0x0E: "Disconnected from the device that needs to stay connected",
+}
+
+StatusQuery = typing.Tuple[str, bytearray, typing.Callable[[bytearray], dict]]
+
+
+# a SwitchBot model, identified by the model byte of its advertised service data
+class DeviceModel(abc.ABC):
+    name = ""
+    model_byte = 0
+    # models that only advertise their state are never connected to
+    connectable = True
+
+    @abc.abstractmethod
+    def device_type(self) -> str:
+        pass
+
+    def enabled(self) -> bool:
+        return bool(self.device_type())
+
+    def status_queries(self) -> typing.Tuple[StatusQuery, ...]:
+        return ()
+
+    # service name -> encoder of the request frame from the command payload
+    def actions(self) -> typing.Dict[str, typing.Callable[[dict], bytearray]]:
+        return {}
+
+    @abc.abstractmethod
+    def decode_service_data(self, service_data: bytes) -> dict:
+        pass
+
+    def services(self) -> typing.List[str]:
+        services = [conf.Senergy.service_status] + list(self.actions())
+        if self.connectable:
+            services.append(conf.Senergy.service_batch)
+        return services
+
+
+_models: typing.Dict[int, DeviceModel] = dict()
+_identified: typing.Dict[str, DeviceModel] = dict()
+
+
+def model_key(model_byte: int) -> int:
+    # bit 7 flags encryption and bit 5 the pairing mode, neither identifies the model
+    return model_byte & 0b01011111
+
+
+def register_model(model: DeviceModel):
+    _models[model_key(model.model_byte)] = model
+
+
+def enabled_models() -> typing.List[DeviceModel]:
+    return [model for model in _models.values() if model.enabled()]
+
+
+def services() -> typing.List[str]:
+    names = []
+    for model in enabled_models():
+        names.extend(name for name in model.services() if name not in names)
+    return names
+
+
+def lookup(service_data: bytes) -> typing.Optional[DeviceModel]:
+    if not service_data:
+        return None
+    model = _models.get(model_key(service_data[0]))
+    if model is None or not model.enabled():
+        return None
+    return model
+
+
+def identify(mac: str, service_data: typing.Optional[bytes]) -> typing.Optional[DeviceModel]:
+    model = lookup(service_data)
+    if model is not None:
+        _identified[mac] = model
+    return model
+
+
+# devices without service data have been probed as curtains ever since
+def model_of(mac: str) -> DeviceModel:
+    model = _identified.get(mac)
+    if model is None:
+        from .curtain import curtain_model
+        model = curtain_model
+    return model
+
+
+def decode_advertisement(service_data: bytes) -> typing.Optional[dict]:
+    model = lookup(service_data)
+    if model is None:
+        return None
+    return model.decode_service_data(service_data)
+
+
+def check_response(response: bytearray):
+    if len(response) == 0:
+        raise RuntimeError("Empty response")
+    if response[0] != response_code_ok:
+        raise RuntimeError(get_err_msg(response[0]))
+
+
+def get_err_msg(code: int) -> str:
+    err_msg = "Code " + str(code) + ": "
+    if code in response_codes:
+        err_msg += response_codes[code]
+    return err_msg
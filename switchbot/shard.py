@@ -0,0 +1,281 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import bisect
+import collections
+import hashlib
+import multiprocessing
+import multiprocessing.connection
+import threading
+import time
+import tracemalloc
+import typing
+
+from util import get_logger, conf, MQTTClient, CommandQueue, init_logger, ERROR_BUSY, ERROR_FAILED
+from util.diagnostics import ResourceSampler
+
+__all__ = ("ShardCoordinator",)
+logger = get_logger(__name__.split(".", 1)[-1])
+
+# spawn instead of fork, the gatt module sets up a GLib main loop on import
+mp = multiprocessing.get_context("spawn")
+
+
+class HashRing:
+    def __init__(self, members: typing.Iterable[int] = ()):
+        self.__keys: typing.List[int] = []
+        self.__members: typing.List[int] = []
+        self.set_members(members)
+
+    @staticmethod
+    def __hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+    def set_members(self, members: typing.Iterable[int]):
+        points = sorted(
+            (self.__hash("{}-{}".format(member, replica)), member)
+            for member in members for replica in range(conf.Shard.virtual_nodes)
+        )
+        self.__keys = [point[0] for point in points]
+        self.__members = [point[1] for point in points]
+
+    def get(self, key: str) -> typing.Optional[int]:
+        if not self.__keys:
+            return None
+        return self.__members[bisect.bisect(self.__keys, self.__hash(key.lower())) % len(self.__keys)]
+
+
+class ShardProxyClient:
+    def __init__(self, index: int, outbound: multiprocessing.Queue):
+        self.__index = index
+        self.__outbound = outbound
+        self.is_connected = False
+
+    def connected(self) -> bool:
+        return self.is_connected
+
+    def publish(self, topic: str, payload: str, qos: int, msg_class: typing.Optional[str] = None) -> None:
+        self.__outbound.put((self.__index, "publish", (topic, payload, qos, msg_class)))
+
+    def send(self, kind: str, *args):
+        self.__outbound.put((self.__index, kind, args))
+
+
+def run_worker(index: int, adapter: str, members: typing.List[int], connected: bool, inbound: multiprocessing.Queue,
+               outbound: multiprocessing.Queue):
+    from switchbot.command import Command
+    from switchbot.models import decode_advertisement
+    from switchbot.discovery import Discovery
+    from switchbot.keep_warm import KeepWarm
+    from switchbot.status_refresh import StatusRefresh
+    from util.adv_ingest import AdvertisementIngest
+    from util.bluez_mirror import attach_ingest
+
+    init_logger(conf.Logger.level)
+    if conf.Diagnostics.enabled:
+        tracemalloc.start(conf.Diagnostics.tracemalloc_frames)
+        ResourceSampler().start()
+    conf.Discovery.adapter = adapter
+    conf.Link.adapters = adapter
+    logger.info("shard worker {} starting on '{}'".format(index, conf.Discovery.adapter))
+    ring = HashRing(members)
+    client = ShardProxyClient(index, outbound)
+    client.is_connected = connected
+    discovery = Discovery(mqtt_client=client)
+    discovery.device_filter = lambda mac: ring.get(mac) == index
+    discovery.on_device_online = lambda device_id: client.send("online", device_id)
+    discovery.on_device_offline = lambda device_id: client.send("offline", device_id)
+    command = Command(mqtt_client=client)
+
+    # the coordinator rejects commands still pending when a worker dies
+    def acknowledged(callback: typing.Callable) -> typing.Callable:
+        def wrapper(device_id: str, service: str, payload: typing.AnyStr, *args, **kwargs):
+            try:
+                callback(device_id, service, payload, *args, **kwargs)
+            finally:
+                client.send("done", device_id, service, payload)
+        return wrapper
+
+    command_queue = CommandQueue(command_callback=acknowledged(command.handle_command),
+                                 reject_callback=acknowledged(command.reject_command))
+    discovery.start()
+    command_queue.start()
+    if conf.KeepWarm.enabled:
+        command.keep_warm = KeepWarm(session_factory=command.session_factory,
+                                     select_adapter=command.scheduler.select_adapter)
+        command.keep_warm.start()
+    if conf.Status.refresh_seconds > 0:
+        StatusRefresh(devices_callback=discovery.macs, refresh_callback=command.refresh_status).start()
+    if conf.Ingest.enabled:
+        ingest = AdvertisementIngest(decoder=decode_advertisement)
+        ingest.add_consumer(discovery.on_advertisements)
+        ingest.add_consumer(command.on_advertisements)
+        attach_ingest(ingest)
+        ingest.start()
+    while True:
+        kind, args = inbound.get()
+        try:
+            if kind == "command":
+                command_queue.put(*args)
+            elif kind == "refresh":
+                client.is_connected = True
+                discovery.publish_devices()
+            elif kind == "members":
+                ring.set_members(args[0])
+                logger.info("shard worker {} rebalancing to members {}".format(index, args[0]))
+                discovery.trigger_refresh()
+        except Exception as ex:
+            logger.error("shard worker {} can't handle '{}' - {}".format(index, kind, ex))
+
+
+class ShardWorker:
+    def __init__(self, index: int, adapter: str):
+        self.index = index
+        self.adapter = adapter
+        self.inbound = mp.Queue()
+        self.process: typing.Optional[multiprocessing.Process] = None
+        self.died_at: typing.Optional[float] = None
+
+    def start(self, members: typing.List[int], connected: bool, outbound: multiprocessing.Queue):
+        self.inbound = mp.Queue()
+        self.process = mp.Process(target=run_worker, name="shard-{}".format(self.index), daemon=True,
+                                  args=(self.index, self.adapter, members, connected, self.inbound, outbound))
+        self.process.start()
+        self.died_at = None
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+
+class ShardCoordinator(threading.Thread):
+    def __init__(self, mqtt_client: MQTTClient, reject_callback: typing.Callable):
+        super().__init__(name="shard-coordinator", daemon=True)
+        self.__mqtt_client = mqtt_client
+        self.__reject_callback = reject_callback
+        self.__outbound = mp.Queue()
+        adapters = [adapter.strip() for adapter in conf.Shard.adapters.split(",") if adapter.strip()]
+        # workers don't coordinate adapter use with each other, so each needs its own
+        if len(adapters) != conf.Shard.workers or len(set(adapters)) != len(adapters):
+            raise RuntimeError("Shard.adapters must list one distinct adapter for each of the {} workers".format(
+                conf.Shard.workers))
+        self.__workers = [ShardWorker(index, adapters[index]) for index in range(conf.Shard.workers)]
+        self.__ring = HashRing()
+        self.__owners: typing.Dict[str, int] = dict()
+        self.__pending: typing.Dict[int, typing.Counter[typing.Tuple[str, str, typing.AnyStr]]] = {
+            worker.index: collections.Counter() for worker in self.__workers
+        }
+        self.__lock = threading.Lock()
+        self.on_device_online = None
+        self.on_device_offline = None
+
+    def __members(self) -> typing.List[int]:
+        return [worker.index for worker in self.__workers if worker.alive()]
+
+    def __rebalance(self):
+        members = self.__members()
+        with self.__lock:
+            self.__ring.set_members(members)
+        logger.info("shard members {}".format(members))
+        self.broadcast("members", members)
+
+    def broadcast(self, kind: str, *args):
+        for worker in self.__workers:
+            if worker.alive():
+                worker.inbound.put((kind, args))
+
+    def refresh(self):
+        self.broadcast("refresh")
+
+    def dispatch(self, device_id: str, service: str, payload: typing.AnyStr):
+        with self.__lock:
+            index = self.__ring.get(device_id.removeprefix(conf.Discovery.device_id_prefix))
+            alive = index is not None and self.__workers[index].alive()
+            if alive:
+                self.__pending[index][(device_id, service, payload)] += 1
+        if not alive:
+            self.__reject_callback(device_id, service, payload, "no shard worker available", kind=ERROR_BUSY)
+            return
+        self.__workers[index].inbound.put(("command", (device_id, service, payload)))
+
+    def __worker_died(self, worker: ShardWorker):
+        with self.__lock:
+            owned = [device_id for device_id, index in self.__owners.items() if index == worker.index]
+            for device_id in owned:
+                del self.__owners[device_id]
+            pending = self.__pending[worker.index]
+            self.__pending[worker.index] = collections.Counter()
+        # surviving workers take over these devices after the rebalance
+        for device_id in owned:
+            if self.on_device_offline:
+                self.on_device_offline(device_id)
+        for (device_id, service, payload), count in pending.items():
+            for _ in range(count):
+                self.__reject_callback(device_id, service, payload, "shard worker died", kind=ERROR_FAILED)
+
+    def __handle_outbound(self):
+        while True:
+            index, kind, args = self.__outbound.get()
+            try:
+                if kind == "publish":
+                    self.__mqtt_client.publish(*args)
+                elif kind == "done":
+                    with self.__lock:
+                        pending = self.__pending[index]
+                        if pending[args] > 1:
+                            pending[args] -= 1
+                        else:
+                            pending.pop(args, None)
+                elif kind == "online":
+                    with self.__lock:
+                        self.__owners[args[0]] = index
+                    if self.on_device_online:
+                        self.on_device_online(args[0])
+                elif kind == "offline":
+                    # a device that moved shards may be reported offline by its previous owner
+                    with self.__lock:
+                        owned = self.__owners.get(args[0], index) == index
+                        if owned:
+                            self.__owners.pop(args[0], None)
+                    if owned and self.on_device_offline:
+                        self.on_device_offline(args[0])
+            except Exception as ex:
+                logger.error("can't handle '{}' from shard worker {} - {}".format(kind, index, ex))
+
+    def run(self) -> None:
+        threading.Thread(target=self.__handle_outbound, name="shard-outbound", daemon=True).start()
+        members = [worker.index for worker in self.__workers]
+        for worker in self.__workers:
+            worker.start(members, self.__mqtt_client.connected(), self.__outbound)
+        self.__rebalance()
+        while True:
+            # wakes up as soon as a worker exits
+            multiprocessing.connection.wait([worker.process.sentinel for worker in self.__workers if worker.alive()],
+                                            timeout=1)
+            changed = False
+            for worker in self.__workers:
+                if worker.process is not None and not worker.alive() and worker.died_at is None:
+                    logger.error("shard worker {} died with exit code {}".format(worker.index, worker.process.exitcode))
+                    worker.died_at = time.time()
+                    self.__worker_died(worker)
+                    changed = True
+                elif worker.died_at is not None and time.time() - worker.died_at > conf.Shard.restart_delay_seconds:
+                    logger.info("restarting shard worker {}".format(worker.index))
+                    worker.start(self.__members() + [worker.index], self.__mqtt_client.connected(), self.__outbound)
+                    changed = True
+            if changed:
+                self.__rebalance()
+                if self.__mqtt_client.connected():
+                    self.refresh()
@@ -0,0 +1,50 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import threading
+import time
+import typing
+
+from util import conf, get_logger
+from util.diagnostics import register_metrics
+
+__all__ = ("StatusRefresh",)
+logger = get_logger(__name__.split(".", 1)[-1])
+
+
+# polls the status of known devices at background priority, interactive commands on the same adapter go first
+class StatusRefresh(threading.Thread):
+    def __init__(self, devices_callback: typing.Callable[[], typing.List[str]],
+                 refresh_callback: typing.Callable[[str], None]):
+        super().__init__(name="status-refresh", daemon=True)
+        self.__devices_callback = devices_callback
+        self.__refresh_callback = refresh_callback
+        self.__stats = {"rounds": 0, "refreshed": 0, "failed": 0}
+        register_metrics("status_refresh", self.metrics)
+
+    def run(self) -> None:
+        while True:
+            time.sleep(conf.Status.refresh_seconds)
+            for device_id in self.__devices_callback():
+                try:
+                    self.__refresh_callback(device_id)
+                    self.__stats["refreshed"] += 1
+                except Exception as ex:
+                    self.__stats["failed"] += 1
+                    logger.warning("status refresh of {} failed - {}".format(device_id, ex))
+            self.__stats["rounds"] += 1
+
+    def metrics(self) -> dict:
+        return dict(self.__stats)
@@ -23,6 +23,10 @@ from .config import *
 from .logger import *
 from .mqtt import *
 from .router import *
+from .command_queue import *
+from .device_publisher import *
+from .http_api import *
+from .refresh import *
 
 from mgw_dc.dm import Device
 
@@ -31,6 +35,10 @@ __all__ = (
     logger.__all__,
     mqtt.__all__,
     router.__all__,
+    command_queue.__all__,
+    device_publisher.__all__,
+    http_api.__all__,
+    refresh.__all__,
 )
 
 
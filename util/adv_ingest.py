@@ -0,0 +1,148 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import array
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from util import get_logger, conf
+from util.diagnostics import register_metrics
+
+logger = get_logger(__name__.split(".", 1)[-1])
+
+Advertisement = Tuple[str, Optional[int], float, dict]
+
+_decode_error = object()
+
+
+def carries_service_data(properties: Dict[str, Any]) -> bool:
+    service_data = properties.get('ServiceData')
+    return bool(service_data) and conf.Discovery.service_data_uuid in service_data
+
+
+# fixed-size slots so that buffering an advertisement does not allocate per signal
+class AdvertisementBuffer:
+    def __init__(self, capacity: int, slot_size: int):
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.payloads = bytearray(capacity * slot_size)
+        self.lengths = array.array('B', bytes(capacity))
+        self.rssi = array.array('h', bytes(2 * capacity))
+        self.has_rssi = array.array('B', bytes(capacity))
+        self.timestamps = array.array('d', bytes(8 * capacity))
+        self.macs: List[Optional[str]] = [None] * capacity
+        self.count = 0
+
+    def append(self, mac: str, payload: bytes, rssi: Optional[int], timestamp: float) -> bool:
+        if self.count >= self.capacity:
+            return False
+        slot = self.count
+        length = min(len(payload), self.slot_size)
+        offset = slot * self.slot_size
+        self.payloads[offset:offset + length] = payload[:length]
+        self.lengths[slot] = length
+        self.has_rssi[slot] = rssi is not None
+        self.rssi[slot] = rssi if rssi is not None else 0
+        self.timestamps[slot] = timestamp
+        self.macs[slot] = mac
+        self.count += 1
+        return True
+
+    def payload(self, slot: int) -> bytes:
+        offset = slot * self.slot_size
+        return bytes(self.payloads[offset:offset + self.lengths[slot]])
+
+
+class AdvertisementIngest(threading.Thread):
+    # the decoder returns None for payloads of unsupported device models
+    def __init__(self, decoder: Callable[[bytes], Optional[dict]]):
+        super().__init__(name="advertisement-ingest", daemon=True)
+        self.__decoder = decoder
+        self.__consumers: List[Callable[[List[Advertisement]], None]] = []
+        self.__active = AdvertisementBuffer(conf.Ingest.capacity, conf.Ingest.slot_size)
+        self.__spare = AdvertisementBuffer(conf.Ingest.capacity, conf.Ingest.slot_size)
+        self.__lock = threading.Lock()
+        self.__stats = {"offered": 0, "filtered": 0, "accepted": 0, "dropped": 0, "coalesced": 0, "decoded": 0,
+                        "unsupported": 0, "decode_errors": 0, "batches": 0, "decode_seconds": 0.0}
+        register_metrics("advertisement_ingest", self.metrics)
+
+    def add_consumer(self, consumer: Callable[[List[Advertisement]], None]):
+        self.__consumers.append(consumer)
+
+    # called from D-Bus signal handlers, must stay cheap
+    def offer(self, path: str, properties: Dict[str, Any]):
+        self.__stats["offered"] += 1
+        if not carries_service_data(properties):
+            self.__stats["filtered"] += 1
+            return
+        service_data = properties['ServiceData']
+        rssi = properties.get('RSSI')
+        mac = path[-17:].replace('_', ':').lower()
+        with self.__lock:
+            accepted = self.__active.append(mac, bytes(service_data[conf.Discovery.service_data_uuid]),
+                                            int(rssi) if rssi is not None else None, time.time())
+        if accepted:
+            self.__stats["accepted"] += 1
+        else:
+            self.__stats["dropped"] += 1
+
+    # one copy of the slot area per batch, only the newest advertisement of each device is kept
+    # and identical payloads are decoded once
+    def __decode(self, buffer: AdvertisementBuffer) -> List[Advertisement]:
+        count, size = buffer.count, buffer.slot_size
+        buffer.count = 0
+        data = bytes(buffer.payloads[:count * size])
+        slots = sorted(dict(zip(buffer.macs[:count], range(count))).values())
+        self.__stats["coalesced"] += count - len(slots)
+        payloads = [data[slot * size:slot * size + buffer.lengths[slot]] for slot in slots]
+        decoded = dict()
+        for payload in set(payloads):
+            try:
+                decoded[payload] = self.__decoder(payload)
+            except Exception:
+                decoded[payload] = _decode_error
+        batch = []
+        for slot, payload in zip(slots, payloads):
+            fields = decoded[payload]
+            if fields is _decode_error:
+                self.__stats["decode_errors"] += 1
+            elif fields is None:
+                self.__stats["unsupported"] += 1
+            else:
+                batch.append((buffer.macs[slot], buffer.rssi[slot] if buffer.has_rssi[slot] else None,
+                              buffer.timestamps[slot], fields))
+        return batch
+
+    def run(self) -> None:
+        while True:
+            time.sleep(conf.Ingest.interval_seconds)
+            with self.__lock:
+                if self.__active.count == 0:
+                    continue
+                buffer, self.__active, self.__spare = self.__active, self.__spare, self.__active
+            started = time.monotonic()
+            batch = self.__decode(buffer)
+            self.__stats["decode_seconds"] += time.monotonic() - started
+            self.__stats["decoded"] += len(batch)
+            self.__stats["batches"] += 1
+            for consumer in self.__consumers:
+                try:
+                    consumer(batch)
+                except Exception as ex:
+                    logger.error("advertisement consumer failed - {}".format(ex))
+
+    def metrics(self) -> dict:
+        return dict(self.__stats, buffered=self.__active.count)
@@ -13,13 +13,16 @@
    See the License for the specific language governing permissions and
    limitations under the License.
 """
+import json
 from typing import Callable, Optional
 
 import dbus
 import gatt
 from gatt import errors
 
-from util import get_logger
+from util import get_logger, conf
+from util.ble_trace import get_recorder
+from util.bluez_mirror import get_mirror
 
 logger = get_logger(__name__.split(".", 1)[-1])
 
@@ -46,12 +49,14 @@ class BLEDevice(gatt.Device):
 
         for service in self.services:
             logger.debug("Device offers service " + service.uuid)
+        self._record("resolve", ",".join(service.uuid for service in self.services))
 
         if self.has_on_ready_callback:
             self.on_ready_callback(self)
 
     def characteristic_value_updated(self, characteristic, value):
         logger.debug("Characteristic " + characteristic.uuid + " updated: " + value.hex())
+        self._record("notification", value.hex())
         if self.has_on_notification_callback:
             self.on_notification_callback(self, characteristic, value)
 
@@ -76,7 +81,9 @@ class BLEDevice(gatt.Device):
             if service.uuid == service_uuid:
                 for char in service.characteristics:
                     if char.uuid == char_uuid:
-                        logger.debug("Writing service " + service_uuid + ", characteristic " + char_uuid + ", value: " + value.hex())
+                        logger.debug("Writing service " + service_uuid + ", characteristic " + char_uuid +
+                                     ", value: " + value.hex())
+                        self._record("write", value.hex())
                         return char.write_value(value)
 
     def notify(self, service_uuid: str, char_uuid: str):
@@ -88,6 +95,11 @@ class BLEDevice(gatt.Device):
 
     def connect(self):
         logger.debug("Connecting " + self.mac_address)
+        if get_recorder():
+            rssi = self._get_property('RSSI')
+            self._record("advertisement", json.dumps({"alias": self.alias(), "rssi": int(rssi) if rssi is not None else None}))
+            self.get_service_data()
+        self._record("connect")
         super().connect()
 
     def connect_succeeded(self):
@@ -96,28 +108,45 @@ class BLEDevice(gatt.Device):
 
     def connect_failed(self, error):
         logger.debug("Connection failed " + self.mac_address + ": " + str(error))
+        self._record("connect_failed", str(error))
         super().connect_failed(error)
 
     def disconnect(self):
         logger.debug("Disconnecting " + self.mac_address)
+        self._record("disconnect")
         super().disconnect()
 
     def disconnect_succeeded(self):
         logger.debug("Disconnected " + self.mac_address)
         super().disconnect_succeeded()
 
+    def resume_signals(self):
+        # the manager drops all device signal receivers whenever its main loop ends
+        self._connect_signals()
+
+    def alias(self):
+        return self._get_property('Alias')
+
     def get_manufacturer_data(self):
-        try:
-            return self._properties.Get('org.bluez.Device1', 'ManufacturerData')
-        except dbus.exceptions.DBusException as e:
-            if e.get_dbus_name() == 'org.freedesktop.DBus.Error.UnknownObject':
-                return None
-            else:
-                raise _error_from_dbus_error(e)
+        return self._get_property('ManufacturerData')
 
     def get_service_data(self):
+        service_data = self._get_property('ServiceData')
+        if service_data is not None and conf.Discovery.service_data_uuid in service_data:
+            self._record("service_data", bytes(service_data[conf.Discovery.service_data_uuid]).hex())
+        return service_data
+
+    def _record(self, event: str, data: str = ""):
+        recorder = get_recorder()
+        if recorder:
+            recorder.record(self.mac_address, event, data)
+
+    def _get_property(self, name: str):
+        mirror = get_mirror()
+        if mirror.has(self._device_path):
+            return mirror.get(self._device_path, name)
         try:
-            return self._properties.Get('org.bluez.Device1', 'ServiceData')
+            return self._properties.Get('org.bluez.Device1', name)
         except dbus.exceptions.DBusException as e:
             if e.get_dbus_name() == 'org.freedesktop.DBus.Error.UnknownObject':
                 return None
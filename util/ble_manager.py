@@ -13,13 +13,15 @@
    See the License for the specific language governing permissions and
    limitations under the License.
 """
-import _thread
-import time
+import logging
+import threading
 import gatt
 
 from typing import Callable, Optional, List
 from util import get_logger
 from util.ble_device import BLEDevice
+from util.adv_ingest import carries_service_data
+from util.bluez_mirror import get_mirror
 
 logger = get_logger(__name__.split(".", 1)[-1])
 
@@ -42,17 +44,40 @@ class BLEDeviceManager(gatt.DeviceManager):
         return BLEDevice(mac_address, self, self.on_ready_callback if self.has_on_ready_callback else None,
                          self.on_notification_callback if self.has_on_notification_callback else None)
 
+    def update_devices(self):
+        for path in get_mirror().paths():
+            mac_address = self._mac_address(path)
+            if mac_address is not None and mac_address not in self._devices:
+                self.make_device(mac_address)
+
+    # signals without SwitchBot service data are dropped here, before gatt creates a device for them
+    def _interfaces_added(self, path, interfaces):
+        if carries_service_data(interfaces.get('org.bluez.Device1', {})):
+            super()._interfaces_added(path, interfaces)
+
+    def _properties_changed(self, interface, changed, invalidated, path):
+        if carries_service_data(changed):
+            super()._properties_changed(interface, changed, invalidated, path)
+
     def device_discovered(self, device: gatt.Device):
-        logger.debug("Discovered [%s] %s" % (device.mac_address, device.alias()))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Discovered [%s] %s" % (device.mac_address, get_mirror().get(device._device_path, 'Alias')))
 
     def run(self, timeout_seconds: Optional[float] = None):
-        if timeout_seconds is not None:
-            _thread.start_new_thread(self.stop_after_timeout, (timeout_seconds,))
         if self._main_loop:
             return
+        timer = None
+        if timeout_seconds is not None:
+            timer = threading.Timer(timeout_seconds, self.stop)
+            timer.daemon = True
+            timer.start()
         logger.debug("Running")
         self.is_adapter_powered = True
-        super().run()
+        try:
+            super().run()
+        finally:
+            if timer:
+                timer.cancel()
 
     def stop(self):
         if self._main_loop:
@@ -67,7 +92,3 @@ class BLEDeviceManager(gatt.DeviceManager):
     def stop_discovery(self):
         logger.debug("Stop discovery")
         super().stop_discovery()
-
-    def stop_after_timeout(self, timeout_seconds: float):
-        time.sleep(timeout_seconds)
-        self.stop()
@@ -0,0 +1,104 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+from typing import List
+
+import gatt
+from gi.repository import GLib
+
+from util import get_logger, conf
+from util.ble_device import BLEDevice
+from util.ble_manager import BLEDeviceManager
+
+logger = get_logger(__name__.split(".", 1)[-1])
+
+
+# one connection and notification subscription, any number of request frames exchanged for their responses
+class BLESession:
+    def __init__(self, mac: str, adapter_name: str = None):
+        self.mac = mac
+        self.manager = BLEDeviceManager(adapter_name=adapter_name or conf.Discovery.adapter)
+        self.device = BLEDevice(mac, self.manager, self.__ready_callback, self.__notification_callback)
+        self.connected = False
+        self.__frames: List[bytearray] = []
+        self.__responses: List[bytearray] = []
+
+    def connect(self, timeout_seconds: float):
+        self.device.connect()
+        if not self.connected:
+            self.manager.run(timeout_seconds)
+        if not self.connected:
+            raise RuntimeError("Could not establish connection")
+
+    def exchange(self, frames: List[bytearray], timeout_seconds: float) -> List[bytearray]:
+        if not self.connected:
+            raise RuntimeError("Not connected")
+        if not frames:
+            return []
+        self.device.resume_signals()
+        self.__discard_queued()
+        self.__frames = list(frames)
+        self.__responses = []
+        self.__write_next()
+        self.manager.run(timeout_seconds)
+        responses = self.__responses
+        self.__frames = []
+        if len(responses) < len(frames):
+            raise RuntimeError("Timeout after {} of {} responses".format(len(responses), len(frames)))
+        return responses
+
+    def is_alive(self) -> bool:
+        if not self.connected:
+            return False
+        try:
+            return self.device.is_connected()
+        except Exception:
+            return False
+
+    def close(self):
+        if self.connected:
+            self.connected = False
+            try:
+                self.device.disconnect()
+            except Exception as ex:
+                logger.debug("Disconnect failed " + self.mac + ": " + str(ex))
+        self.manager.stop()
+
+    # notifications that arrived after an earlier exchange ended are dispatched while no request is
+    # outstanding, responses carry no request id and would otherwise answer the next request
+    def __discard_queued(self):
+        self.__frames = []
+        context = GLib.MainContext.default()
+        while context.pending():
+            context.iteration(False)
+
+    def __write_next(self):
+        self.device.write(conf.Discovery.service_uuid, conf.Discovery.sending_char_uuid,
+                          self.__frames[len(self.__responses)])
+
+    def __ready_callback(self, device: BLEDevice):
+        device.notify(conf.Discovery.service_uuid, conf.Discovery.receiving_char_uuid)
+        self.connected = True
+        self.manager.stop()
+
+    def __notification_callback(self, _: BLEDevice, __: gatt.Characteristic, value: bytearray):
+        if len(self.__responses) >= len(self.__frames):
+            logger.debug("Ignoring unsolicited notification " + bytes(value).hex())
+            return
+        self.__responses.append(bytearray(value))
+        if len(self.__responses) < len(self.__frames):
+            self.__write_next()
+        else:
+            self.manager.stop()
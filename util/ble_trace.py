@@ -0,0 +1,353 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import atexit
+import gzip
+import json
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from util import get_logger, conf
+
+logger = get_logger(__name__.split(".", 1)[-1])
+
+Event = Tuple[float, str, str]
+
+
+# a replayed write differs from the recorded one, so the recorded response doesn't apply
+class TraceDivergence(RuntimeError):
+    pass
+
+
+def open_trace(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t")
+    return open(path, mode, buffering=1)
+
+
+# one json array per line: [monotonic time, mac, event, data]
+class TraceRecorder:
+    def __init__(self, path: str):
+        self.__file = open_trace(path, "a")
+        self.__lock = threading.Lock()
+        self.__dirty = False
+        # flushed periodically, a killed process must leave a trace that can still be loaded
+        threading.Thread(target=self.__flush_periodically, name="trace-flush", daemon=True).start()
+        atexit.register(self.close)
+        logger.info("Recording BLE trace to " + path)
+
+    def record(self, mac: str, event: str, data: str = ""):
+        line = json.dumps([round(time.monotonic(), 6), mac, event, data], separators=(",", ":"))
+        with self.__lock:
+            if not self.__file.closed:
+                self.__file.write(line + "\n")
+                self.__dirty = True
+
+    def __flush_periodically(self):
+        while True:
+            time.sleep(conf.Trace.flush_seconds)
+            with self.__lock:
+                if self.__file.closed:
+                    return
+                if self.__dirty:
+                    self.__file.flush()
+                    self.__dirty = False
+
+    def close(self):
+        with self.__lock:
+            if not self.__file.closed:
+                self.__file.close()
+
+
+class Trace:
+    def __init__(self, path: str):
+        self.__events: Dict[str, List[Event]] = dict()
+        with open_trace(path, "r") as file:
+            try:
+                for number, line in enumerate(file, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        timestamp, mac, event, data = json.loads(line)
+                    except ValueError:
+                        logger.warning("Skipping malformed line {} of BLE trace {}".format(number, path))
+                        continue
+                    self.__events.setdefault(mac, []).append((timestamp, event, data))
+            except EOFError:
+                logger.warning("BLE trace {} is truncated, replaying the events before the cut".format(path))
+        self.__advertisements = {mac: self.__advertisement(events) for mac, events in self.__events.items()}
+        self.__segments: Dict[str, List[List[Event]]] = {mac: self.__split(events) for mac, events in self.__events.items()}
+        self.__cursors: Dict[str, int] = dict()
+        self.__lock = threading.Lock()
+        logger.info("Loaded BLE trace {} with {} device(s)".format(path, len(self.__events)))
+
+    @staticmethod
+    def __split(events: List[Event]) -> List[List[Event]]:
+        segments = []
+        for event in events:
+            if event[1] == "connect" or not segments:
+                segments.append([])
+            segments[-1].append(event)
+        return [segment for segment in segments if segment[0][1] == "connect"]
+
+    def macs(self) -> List[str]:
+        return list(self.__events)
+
+    @staticmethod
+    def __advertisement(events: List[Event]) -> Dict[str, Any]:
+        advertisement = dict()
+        for _, event, data in events:
+            if event == "advertisement":
+                advertisement.update(json.loads(data))
+            elif event == "service_data":
+                advertisement["service_data"] = data
+        return advertisement
+
+    # latest recorded advertisement fields, merged once when the trace is loaded
+    def advertisement(self, mac: str) -> Dict[str, Any]:
+        return self.__advertisements.get(mac, {})
+
+    # connections of a device are replayed in recorded order, starting over once all were used
+    def next_segment(self, mac: str) -> List[Event]:
+        segments = self.__segments.get(mac)
+        if not segments:
+            raise RuntimeError("No recorded connection for " + mac)
+        with self.__lock:
+            cursor = self.__cursors.get(mac, 0)
+            self.__cursors[mac] = (cursor + 1) % len(segments)
+        return segments[cursor]
+
+
+_recorder: Optional[TraceRecorder] = None
+_trace: Optional[Trace] = None
+_lock = threading.Lock()
+
+
+def get_recorder() -> Optional[TraceRecorder]:
+    global _recorder
+    if not conf.Trace.record_path:
+        return None
+    with _lock:
+        if _recorder is None:
+            _recorder = TraceRecorder(conf.Trace.record_path)
+        return _recorder
+
+
+def replay_enabled() -> bool:
+    return bool(conf.Trace.replay_path)
+
+
+def get_trace() -> Trace:
+    global _trace
+    with _lock:
+        if _trace is None:
+            _trace = Trace(conf.Trace.replay_path)
+        return _trace
+
+
+def replay_wait(seconds: float, event: Optional[threading.Event] = None):
+    if conf.Trace.replay_speed <= 0 or seconds <= 0:
+        return
+    if event:
+        event.wait(seconds / conf.Trace.replay_speed)
+    else:
+        time.sleep(seconds / conf.Trace.replay_speed)
+
+
+class ReplayService:
+    def __init__(self, uuid: str):
+        self.uuid = uuid
+        self.characteristics = []
+
+
+class ReplayDevice:
+    def __init__(self, mac: str, manager: Optional["ReplayManager"] = None, on_ready_callback: Optional[Callable] = None):
+        self.mac_address = mac
+        self.manager = manager
+        self.services: List[ReplayService] = []
+        self.on_ready_callback = on_ready_callback
+        self.properties = get_trace().advertisement(mac)
+
+    def update(self, event: str, data: str):
+        if event == "advertisement":
+            self.properties.update(json.loads(data))
+        elif event == "service_data":
+            self.properties["service_data"] = data
+        elif event == "resolve":
+            self.services = [ReplayService(uuid) for uuid in data.split(",") if uuid]
+
+    def alias(self):
+        return self.properties.get("alias")
+
+    def get_manufacturer_data(self):
+        return None
+
+    def get_service_data(self):
+        if "service_data" not in self.properties:
+            return None
+        return {conf.Discovery.service_data_uuid: bytes.fromhex(self.properties["service_data"])}
+
+    def connect(self):
+        self.manager.queue_connect(self, get_trace().next_segment(self.mac_address))
+
+    def disconnect(self):
+        pass
+
+
+# stands in for BLEDeviceManager in Discovery
+class ReplayManager:
+    def __init__(self, adapter_name: str, on_ready_callback: Optional[Callable] = None,
+                 on_notification_callback: Optional[Callable] = None):
+        self.adapter_name = adapter_name
+        self.__devices = {mac: ReplayDevice(mac, self, on_ready_callback) for mac in get_trace().macs()}
+        self.__pending: Optional[Tuple[ReplayDevice, List[Event]]] = None
+        self.__stopped = threading.Event()
+
+    def devices(self):
+        return self.__devices.values()
+
+    def start_discovery(self, uuids: Optional[List[str]] = None):
+        pass
+
+    def stop_discovery(self):
+        pass
+
+    def queue_connect(self, device: ReplayDevice, segment: List[Event]):
+        self.__pending = (device, segment)
+
+    def run(self, timeout_seconds: Optional[float] = None):
+        self.__stopped.clear()
+        pending, self.__pending = self.__pending, None
+        if pending is None:
+            replay_wait(timeout_seconds or 0, self.__stopped)
+            return
+        device, segment = pending
+        for timestamp, event, data in segment:
+            elapsed = timestamp - segment[0][0]
+            if timeout_seconds is not None and elapsed > timeout_seconds:
+                break
+            device.update(event, data)
+            if event == "resolve":
+                replay_wait(elapsed, self.__stopped)
+                if device.on_ready_callback:
+                    device.on_ready_callback(device)
+                return
+            if event == "connect_failed":
+                replay_wait(elapsed, self.__stopped)
+                return
+        replay_wait(timeout_seconds or 0, self.__stopped)
+
+    def stop(self):
+        self.__stopped.set()
+
+
+# stands in for BLESession in Command
+class ReplaySession:
+    def __init__(self, mac: str, adapter_name: str = None):
+        self.mac = mac
+        self.device = ReplayDevice(mac)
+        self.connected = False
+        self.__segment: List[Event] = []
+        self.__position = 0
+
+    def connect(self, timeout_seconds: float):
+        self.__segment = get_trace().next_segment(self.mac)
+        self.__position = 0
+        started = self.__segment[0][0]
+        for position, (timestamp, event, data) in enumerate(self.__segment):
+            if timestamp - started > timeout_seconds:
+                break
+            self.device.update(event, data)
+            if event == "resolve":
+                replay_wait(timestamp - started)
+                self.connected = True
+                self.__position = position + 1
+                return
+            if event == "connect_failed":
+                replay_wait(timestamp - started)
+                break
+        raise RuntimeError("Could not establish connection")
+
+    def __advance(self, until: Tuple[str, ...]) -> Optional[Event]:
+        while self.__position < len(self.__segment):
+            timestamp, event, data = self.__segment[self.__position]
+            self.__position += 1
+            self.device.update(event, data)
+            if event in until:
+                return timestamp, event, data
+        return None
+
+    def exchange(self, frames: List[bytearray], timeout_seconds: float) -> List[bytearray]:
+        if not self.connected:
+            raise RuntimeError("Not connected")
+        responses = []
+        elapsed = 0.0
+        for frame in frames:
+            write = self.__advance(("write", "disconnect"))
+            if write is None or write[1] != "write":
+                break
+            if write[2] != frame.hex():
+                raise TraceDivergence("Replay of {} diverges, recorded write {} but got {}".format(
+                    self.mac, write[2], frame.hex()))
+            notification = self.__advance(("notification", "disconnect"))
+            if notification is None or notification[1] != "notification":
+                break
+            elapsed += notification[0] - write[0]
+            if elapsed > timeout_seconds:
+                break
+            replay_wait(notification[0] - write[0])
+            responses.append(bytearray.fromhex(notification[2]))
+        if len(responses) < len(frames):
+            raise RuntimeError("Timeout after {} of {} responses".format(len(responses), len(frames)))
+        return responses
+
+    def is_alive(self) -> bool:
+        return self.connected
+
+    def close(self):
+        self.connected = False
+
+
+# stands in for PropertyMirror, serving the last recorded advertisement of each device
+class ReplayMirror:
+    @staticmethod
+    def __mac(path: str) -> str:
+        return path.rsplit("dev_", 1)[-1].replace("_", ":").lower()
+
+    def has(self, path: str) -> bool:
+        return self.__mac(path) in get_trace().macs()
+
+    def get(self, path: str, name: str, default: Any = None) -> Any:
+        advertisement = get_trace().advertisement(self.__mac(path))
+        if name == "Alias":
+            return advertisement.get("alias", default)
+        if name == "RSSI":
+            return advertisement.get("rssi", default)
+        if name == "ServiceData" and "service_data" in advertisement:
+            return {conf.Discovery.service_data_uuid: bytes.fromhex(advertisement["service_data"])}
+        return default
+
+    @staticmethod
+    def last_advertised(_: str) -> Optional[float]:
+        return None
+
+    def last_rssi(self, path: str) -> Optional[int]:
+        return self.get(path, "RSSI")
+
+    @staticmethod
+    def paths() -> List[str]:
+        return ['/org/bluez/%s/dev_%s' % (conf.Discovery.adapter, mac.replace(':', '_').upper())
+                for mac in get_trace().macs()]
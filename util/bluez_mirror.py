@@ -0,0 +1,144 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import threading
+import time
+from typing import Any, Dict, List, Optional, Union
+
+import dbus
+
+from util import get_logger, conf
+from util.ble_trace import replay_enabled, ReplayMirror
+from util.adv_ingest import AdvertisementIngest
+
+logger = get_logger(__name__.split(".", 1)[-1])
+
+device_interface = 'org.bluez.Device1'
+advertisement_properties = ('RSSI', 'ManufacturerData', 'ServiceData', 'TxPower')
+
+
+# Device1 properties of all BlueZ objects, seeded once and kept current by signals dispatched in any running main loop
+class PropertyMirror:
+    def __init__(self, bus: dbus.Bus):
+        self.__bus = bus
+        self.__object_manager = dbus.Interface(bus.get_object("org.bluez", "/"), "org.freedesktop.DBus.ObjectManager")
+        self.__devices: Dict[str, Dict[str, Any]] = dict()
+        self.__advertised: Dict[str, float] = dict()
+        # BlueZ invalidates RSSI when a scan ends, the last advertised value is kept here
+        self.__rssi: Dict[str, int] = dict()
+        self.__lock = threading.Lock()
+        self.__synced = 0.0
+        self.__bus.add_signal_receiver(
+            self.__interfaces_added,
+            dbus_interface='org.freedesktop.DBus.ObjectManager',
+            signal_name='InterfacesAdded')
+        self.__bus.add_signal_receiver(
+            self.__interfaces_removed,
+            dbus_interface='org.freedesktop.DBus.ObjectManager',
+            signal_name='InterfacesRemoved')
+        self.__bus.add_signal_receiver(
+            self.__properties_changed,
+            dbus_interface=dbus.PROPERTIES_IFACE,
+            signal_name='PropertiesChanged',
+            arg0=device_interface,
+            path_keyword='path')
+        self.sync()
+
+    def sync(self):
+        devices = {
+            str(path): dict(interfaces[device_interface])
+            for path, interfaces in self.__object_manager.GetManagedObjects().items()
+            if device_interface in interfaces
+        }
+        with self.__lock:
+            self.__devices = devices
+            self.__rssi.update((path, int(properties['RSSI'])) for path, properties in devices.items()
+                               if 'RSSI' in properties)
+            self.__synced = time.monotonic()
+        logger.debug("Mirrored {} device(s)".format(len(devices)))
+
+    def __sync_if_stale(self):
+        if time.monotonic() - self.__synced > conf.Mirror.resync_seconds:
+            self.sync()
+
+    def __interfaces_added(self, path, interfaces):
+        if device_interface in interfaces:
+            if _ingest:
+                _ingest.offer(str(path), interfaces[device_interface])
+            with self.__lock:
+                self.__devices.setdefault(str(path), dict()).update(interfaces[device_interface])
+                self.__advertised[str(path)] = time.time()
+                if 'RSSI' in interfaces[device_interface]:
+                    self.__rssi[str(path)] = int(interfaces[device_interface]['RSSI'])
+
+    def __interfaces_removed(self, path, interfaces):
+        if device_interface in interfaces:
+            with self.__lock:
+                self.__devices.pop(str(path), None)
+                self.__advertised.pop(str(path), None)
+                self.__rssi.pop(str(path), None)
+
+    def __properties_changed(self, interface, changed, invalidated, path):
+        # every Device1 signal is offered, the ingest counts and filters them
+        if _ingest:
+            _ingest.offer(str(path), changed)
+        with self.__lock:
+            properties = self.__devices.setdefault(str(path), dict())
+            properties.update(changed)
+            for name in invalidated:
+                properties.pop(name, None)
+            if any(name in changed for name in advertisement_properties):
+                self.__advertised[str(path)] = time.time()
+            if 'RSSI' in changed:
+                self.__rssi[str(path)] = int(changed['RSSI'])
+
+    def has(self, path: str) -> bool:
+        self.__sync_if_stale()
+        return path in self.__devices
+
+    def get(self, path: str, name: str, default: Any = None) -> Any:
+        self.__sync_if_stale()
+        properties = self.__devices.get(path)
+        if properties is None:
+            return default
+        return properties.get(name, default)
+
+    def last_advertised(self, path: str) -> Optional[float]:
+        return self.__advertised.get(path)
+
+    def last_rssi(self, path: str) -> Optional[int]:
+        return self.__rssi.get(path)
+
+    def paths(self) -> List[str]:
+        self.__sync_if_stale()
+        return list(self.__devices)
+
+
+_mirror: Optional[Union[PropertyMirror, ReplayMirror]] = None
+_mirror_lock = threading.Lock()
+_ingest: Optional[AdvertisementIngest] = None
+
+
+def attach_ingest(ingest: AdvertisementIngest):
+    global _ingest
+    _ingest = ingest
+
+
+def get_mirror() -> Union[PropertyMirror, ReplayMirror]:
+    global _mirror
+    with _mirror_lock:
+        if _mirror is None:
+            _mirror = ReplayMirror() if replay_enabled() else PropertyMirror(dbus.SystemBus())
+        return _mirror
@@ -0,0 +1,290 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import multiprocessing
+import os
+import subprocess
+import time
+from typing import Callable, Iterable, List, Optional
+
+import dbus
+import dbus.bus
+import dbus.exceptions
+import dbus.mainloop.glib
+import dbus.service
+from gi.repository import GLib
+
+from util import get_logger, conf
+
+logger = get_logger(__name__.split(".", 1)[-1])
+
+bluez_name = "org.bluez"
+object_manager_interface = "org.freedesktop.DBus.ObjectManager"
+adapter_interface = "org.bluez.Adapter1"
+device_interface = "org.bluez.Device1"
+service_interface = "org.bluez.GattService1"
+characteristic_interface = "org.bluez.GattCharacteristic1"
+
+advertisement_interval_ms = 100
+response_delay_ms = 10
+rssi = -60
+alias = "WoCurtain"
+# curtain at 50 %, calibrated, battery 50 %
+service_data = bytes.fromhex("63c0320a12")
+# request frame -> notification, everything not listed is acknowledged with a bare OK
+responses = {
+    "5702": "0100120080800001",
+    "570f468101": "0180100000000000",
+    "570f460402": "01000003000000",
+}
+
+
+def _bytes(value: bytes) -> dbus.Array:
+    return dbus.Array([dbus.Byte(b) for b in value], signature="y")
+
+
+class SimulatedObject(dbus.service.Object):
+    def __init__(self, bus: dbus.bus.BusConnection, path: str, interface: str, properties: dict):
+        super().__init__(bus, path)
+        self.path = path
+        self.interface = interface
+        self.properties = dbus.Dictionary(properties, signature="sv")
+
+    @dbus.service.method(dbus.PROPERTIES_IFACE, in_signature="ss", out_signature="v")
+    def Get(self, interface, name):
+        if name not in self.properties:
+            raise dbus.exceptions.DBusException("No such property '{}'".format(name),
+                                                name="org.freedesktop.DBus.Error.InvalidArgs")
+        return self.properties[name]
+
+    @dbus.service.method(dbus.PROPERTIES_IFACE, in_signature="s", out_signature="a{sv}")
+    def GetAll(self, interface):
+        return self.properties
+
+    @dbus.service.method(dbus.PROPERTIES_IFACE, in_signature="ssv")
+    def Set(self, interface, name, value):
+        self.update({name: value})
+
+    @dbus.service.signal(dbus.PROPERTIES_IFACE, signature="sa{sv}as")
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+    def update(self, changed: dict, invalidated: Iterable[str] = ()):
+        invalidated = [name for name in invalidated if name in self.properties]
+        for name in invalidated:
+            del self.properties[name]
+        self.properties.update(changed)
+        self.PropertiesChanged(self.interface, dbus.Dictionary(changed, signature="sv"),
+                               dbus.Array(invalidated, signature="s"))
+
+
+class SimulatedCharacteristic(SimulatedObject):
+    def __init__(self, bus: dbus.bus.BusConnection, path: str, service_path: str, uuid: str,
+                 on_write: Optional[Callable[[bytes], None]] = None):
+        super().__init__(bus, path, characteristic_interface, {
+            "UUID": uuid,
+            "Service": dbus.ObjectPath(service_path),
+            "Value": _bytes(b""),
+            "Notifying": dbus.Boolean(False),
+        })
+        self.on_write = on_write
+
+    @dbus.service.method(characteristic_interface, in_signature="aya{sv}")
+    def WriteValue(self, value, options):
+        if self.on_write:
+            self.on_write(bytes(value))
+
+    @dbus.service.method(characteristic_interface)
+    def StartNotify(self):
+        if self.properties["Notifying"]:
+            raise dbus.exceptions.DBusException("Already notifying", name="org.bluez.Error.Failed")
+        self.update({"Notifying": dbus.Boolean(True)})
+
+    @dbus.service.method(characteristic_interface)
+    def StopNotify(self):
+        if not self.properties["Notifying"]:
+            raise dbus.exceptions.DBusException("No notify session started", name="org.bluez.Error.Failed")
+        self.update({"Notifying": dbus.Boolean(False)})
+
+    def notify(self, value: bytes) -> bool:
+        if self.properties["Notifying"]:
+            self.update({"Value": _bytes(value)})
+        return False
+
+
+# a curtain that answers every request frame with a notification
+class SimulatedDevice(SimulatedObject):
+    def __init__(self, bus: dbus.bus.BusConnection, adapter_path: str, mac: str):
+        path = adapter_path + "/dev_" + mac.replace(":", "_").upper()
+        super().__init__(bus, path, device_interface, {
+            "Address": mac.upper(),
+            "Alias": alias,
+            "Adapter": dbus.ObjectPath(adapter_path),
+            "Connected": dbus.Boolean(False),
+            "ServicesResolved": dbus.Boolean(False),
+            "UUIDs": dbus.Array([conf.Discovery.service_uuid], signature="s"),
+            "ServiceData": self.__service_data(),
+        })
+        self.service = SimulatedObject(bus, path + "/service000d", service_interface, {
+            "UUID": conf.Discovery.service_uuid,
+            "Device": dbus.ObjectPath(path),
+            "Primary": dbus.Boolean(True),
+        })
+        self.receiving = SimulatedCharacteristic(bus, self.service.path + "/char000e", self.service.path,
+                                                 conf.Discovery.receiving_char_uuid)
+        self.sending = SimulatedCharacteristic(bus, self.service.path + "/char0010", self.service.path,
+                                               conf.Discovery.sending_char_uuid, self.__respond)
+
+    @staticmethod
+    def __service_data() -> dbus.Dictionary:
+        return dbus.Dictionary({conf.Discovery.service_data_uuid: _bytes(service_data)}, signature="sv")
+
+    def objects(self) -> List[SimulatedObject]:
+        return [self, self.service, self.receiving, self.sending]
+
+    def __respond(self, frame: bytes):
+        response = bytes.fromhex(responses.get(frame.hex(), "01"))
+        GLib.timeout_add(response_delay_ms, self.receiving.notify, response)
+
+    def advertise(self):
+        self.update({"RSSI": dbus.Int16(rssi), "ServiceData": self.__service_data()})
+
+    def end_scan(self):
+        self.update({}, ["RSSI"])
+
+    @dbus.service.method(device_interface)
+    def Connect(self):
+        if not self.properties["Connected"]:
+            self.update({"Connected": dbus.Boolean(True)})
+            self.update({"ServicesResolved": dbus.Boolean(True)})
+
+    @dbus.service.method(device_interface)
+    def Disconnect(self):
+        if self.properties["Connected"]:
+            if self.receiving.properties["Notifying"]:
+                self.receiving.update({"Notifying": dbus.Boolean(False)})
+            self.update({"ServicesResolved": dbus.Boolean(False)})
+            self.update({"Connected": dbus.Boolean(False)})
+
+
+class SimulatedAdapter(SimulatedObject):
+    def __init__(self, bus: dbus.bus.BusConnection, name: str, macs: List[str]):
+        path = "/org/bluez/" + name
+        super().__init__(bus, path, adapter_interface, {
+            "Address": "00:00:00:00:00:00",
+            "Powered": dbus.Boolean(True),
+            "Discovering": dbus.Boolean(False),
+        })
+        self.devices = [SimulatedDevice(bus, path, mac) for mac in macs]
+        self.__advertising: Optional[int] = None
+
+    def objects(self) -> List[SimulatedObject]:
+        objects = [self]
+        for device in self.devices:
+            objects.extend(device.objects())
+        return objects
+
+    def __advertise(self) -> bool:
+        for device in self.devices:
+            device.advertise()
+        return True
+
+    @dbus.service.method(adapter_interface, in_signature="a{sv}")
+    def SetDiscoveryFilter(self, discovery_filter):
+        pass
+
+    @dbus.service.method(adapter_interface)
+    def StartDiscovery(self):
+        if self.__advertising is not None:
+            raise dbus.exceptions.DBusException("Operation already in progress", name="org.bluez.Error.InProgress")
+        self.update({"Discovering": dbus.Boolean(True)})
+        self.__advertising = GLib.timeout_add(advertisement_interval_ms, self.__advertise)
+
+    @dbus.service.method(adapter_interface)
+    def StopDiscovery(self):
+        if self.__advertising is None:
+            raise dbus.exceptions.DBusException("No discovery started", name="org.bluez.Error.Failed")
+        GLib.source_remove(self.__advertising)
+        self.__advertising = None
+        self.update({"Discovering": dbus.Boolean(False)})
+        # BlueZ drops RSSI once a scan ends
+        for device in self.devices:
+            device.end_scan()
+
+    @dbus.service.method(adapter_interface, in_signature="o")
+    def RemoveDevice(self, path):
+        pass
+
+
+class SimulatedObjectManager(dbus.service.Object):
+    def __init__(self, bus: dbus.bus.BusConnection, objects: List[SimulatedObject]):
+        super().__init__(bus, "/")
+        self.objects = objects
+
+    @dbus.service.method(object_manager_interface, out_signature="a{oa{sa{sv}}}")
+    def GetManagedObjects(self):
+        return {obj.path: {obj.interface: obj.properties} for obj in self.objects}
+
+    @dbus.service.signal(object_manager_interface, signature="oa{sa{sv}}")
+    def InterfacesAdded(self, path, interfaces):
+        pass
+
+    @dbus.service.signal(object_manager_interface, signature="oas")
+    def InterfacesRemoved(self, path, interfaces):
+        pass
+
+
+def serve(address: str, adapters: List[str], macs: List[str]):
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.bus.BusConnection(address)
+    simulated = [SimulatedAdapter(bus, adapter, macs) for adapter in adapters]
+    manager = SimulatedObjectManager(bus, [obj for adapter in simulated for obj in adapter.objects()])
+    # the name is claimed last, once it is owned every object is in place
+    name = dbus.service.BusName(bluez_name, bus)
+    logger.debug("{} serving {} object(s)".format(name.get_name(), len(manager.objects)))
+    GLib.MainLoop().run()
+
+
+# BlueZ simulated on a private bus, so that the real D-Bus, GLib and gatt code runs without a radio,
+# the system bus of this process is redirected to it
+class SimulatedBlueZ:
+    def __init__(self, adapters: List[str], macs: List[str]):
+        self.__daemon = subprocess.Popen(["dbus-daemon", "--session", "--nofork", "--print-address=1"],
+                                         stdout=subprocess.PIPE, text=True)
+        self.address = self.__daemon.stdout.readline().strip()
+        if not self.address:
+            self.__daemon.kill()
+            raise RuntimeError("dbus-daemon did not report an address")
+        self.__process = multiprocessing.get_context("spawn").Process(
+            target=serve, args=(self.address, adapters, macs), name="bluez-sim", daemon=True
+        )
+        self.__process.start()
+        bus = dbus.bus.BusConnection(self.address)
+        try:
+            deadline = time.monotonic() + 10
+            while not bus.name_has_owner(bluez_name):
+                if not self.__process.is_alive() or time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError("simulated BlueZ did not start")
+                time.sleep(0.05)
+        finally:
+            bus.close()
+        os.environ["DBUS_SYSTEM_BUS_ADDRESS"] = self.address
+
+    def stop(self):
+        self.__process.terminate()
+        self.__process.join(5)
+        self.__daemon.terminate()
+        self.__daemon.wait(5)
@@ -0,0 +1,94 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("CommandQueue", "InvalidCommand", "ERROR_BUSY", "ERROR_UNKNOWN", "ERROR_REJECTED", "ERROR_FAILED")
+
+
+from .logger import get_logger
+from .config import conf
+import collections
+import threading
+import time
+import typing
+
+
+logger = get_logger(__name__.split(".", 1)[-1])
+
+# kinds of command errors, passed to reply callbacks along with the reason
+ERROR_BUSY = "busy"
+ERROR_UNKNOWN = "unknown"
+ERROR_REJECTED = "rejected"
+ERROR_FAILED = "failed"
+
+
+# the command itself is malformed, repeating it can't succeed
+class InvalidCommand(RuntimeError):
+    pass
+
+
+class CommandQueue(threading.Thread):
+    def __init__(self, command_callback: typing.Callable, reject_callback: typing.Callable):
+        super().__init__(name="command-queue", daemon=True)
+        self.__command_callback = command_callback
+        self.__reject_callback = reject_callback
+        self.__queue = collections.deque()
+        self.__pending = dict()
+        self.__condition = threading.Condition()
+
+    def put(self, device_id: str, service: str, payload: typing.AnyStr, reply: typing.Optional[typing.Callable] = None):
+        with self.__condition:
+            if len(self.__queue) >= conf.Command.queue_size:
+                reason = "command queue full"
+            elif self.__pending.get(device_id, 0) >= conf.Command.device_queue_size:
+                reason = "too many pending commands for device"
+            else:
+                self.__queue.append((time.monotonic() + conf.Command.max_age_seconds, device_id, service, payload, reply))
+                self.__pending[device_id] = self.__pending.get(device_id, 0) + 1
+                self.__condition.notify()
+                return
+        self.__reject(device_id, service, payload, reply, reason)
+
+    def __get(self):
+        with self.__condition:
+            while not self.__queue:
+                self.__condition.wait()
+            item = self.__queue.popleft()
+            device_id = item[1]
+            if self.__pending[device_id] > 1:
+                self.__pending[device_id] -= 1
+            else:
+                del self.__pending[device_id]
+            return item
+
+    def __reject(self, device_id: str, service: str, payload: typing.AnyStr, reply: typing.Optional[typing.Callable],
+                 reason: str):
+        logger.warning("rejecting command for '{}' ({}) - {}".format(device_id, service, reason))
+        try:
+            self.__reject_callback(device_id, service, payload, reason, reply=reply, kind=ERROR_BUSY)
+        except Exception as ex:
+            logger.error("can't reject command for '{}' - {}".format(device_id, ex))
+
+    def run(self) -> None:
+        while True:
+            deadline, device_id, service, payload, reply = self.__get()
+            overdue = time.monotonic() - deadline
+            if overdue > 0:
+                self.__reject(device_id, service, payload, reply, "command expired {:.1f}s ago".format(overdue))
+                continue
+            try:
+                self.__command_callback(device_id, service, payload, reply=reply)
+            except Exception as ex:
+                logger.error("command for '{}' failed - {}".format(device_id, ex))
@@ -37,12 +37,20 @@ class Conf:
         keep_alive = 30
         id = "switchbotcloud-dc"
 
+    @simple_env_var.section
+    class Publish:
+        queue_size = 1000
+        inflight_window = 20
+        qos_response = 2
+        qos_device = 1
+
     @simple_env_var.section
     class Discovery:
         scan_timeout_seconds = 5
         connect_timeout_seconds = 2
         command_timeout_seconds = 3
         scan_delay = 1800
+        full_republish_seconds = 0
         command_retries = 1
         command_retry_wait_seconds = 0.5
         device_id_prefix = "switchbotbluetooth-"
@@ -52,6 +60,94 @@ class Conf:
         sending_char_uuid = "cba20002-224d-11e6-9fb8-0002a5d5c51b"
         service_data_uuid = "00000d00-0000-1000-8000-00805f9b34fb"
 
+    @simple_env_var.section
+    class Status:
+        device_info_timeout_seconds = 1.0
+        extended_settings_timeout_seconds = 1.0
+        charging_timeout_seconds = 1.0
+        retries = 1
+        refresh_seconds = 0
+        cache_seconds = 60
+
+    @simple_env_var.section
+    class Trace:
+        record_path = ""
+        replay_path = ""
+        replay_speed = 1.0
+        flush_seconds = 1.0
+
+    @simple_env_var.section
+    class Ingest:
+        enabled = False
+        capacity = 1024
+        slot_size = 16
+        interval_seconds = 1.0
+
+    @simple_env_var.section
+    class Mirror:
+        resync_seconds = 3600
+
+    @simple_env_var.section
+    class Link:
+        adapters = ""
+        min_rssi = -90
+        max_advertisement_age_seconds = 3600
+
+    @simple_env_var.section
+    class Command:
+        queue_size = 32
+        device_queue_size = 4
+        max_age_seconds = 30
+
+    @simple_env_var.section
+    class KeepWarm:
+        enabled = False
+        max_connections = 2
+        interval_seconds = 60
+        horizon_seconds = 900
+        threshold = 0.5
+        history_size = 500
+        history_days = 14
+
+    @simple_env_var.section
+    class Refresh:
+        debounce_seconds = 2
+
+    @simple_env_var.section
+    class HTTP:
+        enabled = False
+        host = "127.0.0.1"
+        port = 8080
+        unix_socket = ""
+        timeout_seconds = 60
+
+    @simple_env_var.section
+    class Shard:
+        workers = 0
+        adapters = ""
+        virtual_nodes = 64
+        restart_delay_seconds = 5
+
+    @simple_env_var.section
+    class Diagnostics:
+        enabled = False
+        interval_seconds = 300
+        top_allocators = 10
+        tracemalloc_frames = 1
+
+    @simple_env_var.section
+    class Soak:
+        macs = "00:11:22:33:44:55"
+        iterations = 5000
+        warmup_iterations = 100
+        scan_every = 100
+        sample_every = 250
+        max_rss_growth_kib = 20480
+        max_fd_growth = 8
+        max_thread_growth = 4
+        max_failures = 0
+        response_timeout_seconds = 60.0
+
     @simple_env_var.section
     class StartDelay:
         enabled = False
@@ -61,11 +157,17 @@ class Conf:
     @simple_env_var.section
     class Senergy:
         dt_curtain = "urn:infai:ses:device-type:38cf9c47-aebf-481d-8b17-5379e191a470"
+        dt_bot = ""
+        dt_meter = ""
+        dt_contact = ""
         service_status = "status"
         service_command = "set_position"
+        service_batch = "batch"
+        service_press = "press"
+        service_power = "set_power"
 
 
 conf = Conf()
 
-if not conf.Senergy.dt_curtain:
+if not any((conf.Senergy.dt_curtain, conf.Senergy.dt_bot, conf.Senergy.dt_meter, conf.Senergy.dt_contact)):
     exit('Please provide SENERGY device types')
@@ -0,0 +1,79 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import time
+from typing import Iterable, List, Optional, Tuple
+
+from util import get_logger, conf
+from util.bluez_mirror import get_mirror
+
+logger = get_logger(__name__.split(".", 1)[-1])
+
+
+class DeviceOutOfRange(RuntimeError):
+    pass
+
+
+class ConnectionScheduler:
+    def __init__(self):
+        self.adapters = [adapter.strip() for adapter in conf.Link.adapters.split(",") if adapter.strip()]
+        if not self.adapters:
+            self.adapters = [conf.Discovery.adapter]
+
+    @staticmethod
+    def device_path(adapter: str, mac: str) -> str:
+        return '/org/bluez/%s/dev_%s' % (adapter, mac.replace(':', '_').upper())
+
+    def link(self, mac: str, adapter: str = None) -> Tuple[Optional[int], Optional[float]]:
+        mirror = get_mirror()
+        path = self.device_path(adapter or conf.Discovery.adapter, mac)
+        return mirror.last_rssi(path), mirror.last_advertised(path)
+
+    @staticmethod
+    def in_range(rssi: Optional[int], last_advertised: Optional[float]) -> bool:
+        # devices without any link information are given the benefit of the doubt
+        if rssi is not None and rssi < conf.Link.min_rssi:
+            return False
+        if last_advertised is not None and time.time() - last_advertised > conf.Link.max_advertisement_age_seconds:
+            return False
+        return True
+
+    def select_adapter(self, mac: str) -> str:
+        best_adapter = None
+        best_rssi = None
+        for adapter in self.adapters:
+            rssi, last_advertised = self.link(mac, adapter)
+            if not self.in_range(rssi, last_advertised):
+                continue
+            if best_adapter is None or (rssi is not None and (best_rssi is None or rssi > best_rssi)):
+                best_adapter = adapter
+                best_rssi = rssi
+        if best_adapter is None:
+            rssi, last_advertised = self.link(mac, self.adapters[0])
+            raise DeviceOutOfRange("Device {} out of range (rssi {}, last advertised {})".format(
+                mac, rssi, "never" if last_advertised is None else "{:.0f}s ago".format(time.time() - last_advertised)
+            ))
+        logger.debug("Selected adapter {} for {} (rssi {})".format(best_adapter, mac, best_rssi))
+        return best_adapter
+
+    def order(self, macs: Iterable[str], adapter: str = None) -> List[str]:
+        ranked = []
+        for mac in macs:
+            rssi, last_advertised = self.link(mac, adapter)
+            if not self.in_range(rssi, last_advertised):
+                logger.debug("Deferring {} (rssi {})".format(mac, rssi))
+                continue
+            ranked.append((-rssi if rssi is not None else float("inf"), mac))
+        return [mac for _, mac in sorted(ranked)]
@@ -0,0 +1,79 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("DevicePublisher", )
+
+
+from .logger import get_logger
+from .config import conf
+from . import diagnostics
+import json
+import threading
+import time
+import typing
+import mgw_dc
+
+
+logger = get_logger(__name__.split(".", 1)[-1])
+
+
+class DevicePublisher:
+    def __init__(self, mqtt_client):
+        self.__mqtt_client = mqtt_client
+        self.__topic = mgw_dc.dm.gen_device_topic(conf.Client.id)
+        self.__payloads: typing.Dict[str, str] = dict()
+        self.__lock = threading.Lock()
+        self.__last_full_republish = time.monotonic()
+        self.__stats = {"published": 0, "unchanged": 0}
+        diagnostics.register_metrics("device_publisher", self.metrics)
+
+    def __send(self, payload: str):
+        self.__mqtt_client.publish(topic=self.__topic, payload=payload, qos=1, msg_class="device")
+
+    def publish(self, device: mgw_dc.dm.Device, force: bool = False) -> bool:
+        payload = json.dumps(mgw_dc.dm.gen_set_device_msg(device))
+        with self.__lock:
+            if not force and self.__payloads.get(device.id) == payload:
+                self.__stats["unchanged"] += 1
+                return False
+        self.__send(payload)
+        with self.__lock:
+            self.__payloads[device.id] = payload
+            self.__stats["published"] += 1
+        return True
+
+    def forget(self, device_id: str):
+        with self.__lock:
+            self.__payloads.pop(device_id, None)
+
+    def publish_all(self):
+        with self.__lock:
+            payloads = list(self.__payloads.values())
+        for payload in payloads:
+            self.__send(payload)
+        logger.debug("republished {} cached device(s)".format(len(payloads)))
+
+    def full_republish_due(self) -> bool:
+        if conf.Discovery.full_republish_seconds <= 0:
+            return False
+        if time.monotonic() - self.__last_full_republish < conf.Discovery.full_republish_seconds:
+            return False
+        self.__last_full_republish = time.monotonic()
+        return True
+
+    def metrics(self) -> dict:
+        with self.__lock:
+            return dict(self.__stats, cached=len(self.__payloads))
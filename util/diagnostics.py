@@ -0,0 +1,108 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("ResourceSampler", "register_metrics", "collect_metrics")
+
+
+from .logger import get_logger
+from .config import conf
+import json
+import os
+import threading
+import time
+import tracemalloc
+import typing
+
+
+logger = get_logger(__name__.split(".", 1)[-1])
+
+_metric_sources: typing.Dict[str, typing.Callable[[], dict]] = dict()
+
+
+def register_metrics(name: str, source: typing.Callable[[], dict]):
+    _metric_sources[name] = source
+
+
+def collect_metrics() -> dict:
+    metrics = dict()
+    for name, source in list(_metric_sources.items()):
+        try:
+            metrics[name] = source()
+        except Exception as ex:
+            metrics[name] = {"error": str(ex)}
+    return metrics
+
+
+class ResourceSampler(threading.Thread):
+    def __init__(self, interval_seconds: float = None, top_allocators: int = None):
+        super().__init__(name="resource-sampler", daemon=True)
+        self.__interval = interval_seconds or conf.Diagnostics.interval_seconds
+        self.__top_allocators = conf.Diagnostics.top_allocators if top_allocators is None else top_allocators
+        self.__baseline: typing.Optional[tracemalloc.Snapshot] = None
+        self.first: typing.Optional[dict] = None
+        self.last: typing.Optional[dict] = None
+
+    @staticmethod
+    def rss_bytes() -> int:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+    @staticmethod
+    def fd_count() -> int:
+        return len(os.listdir("/proc/self/fd"))
+
+    def sample(self) -> dict:
+        sample = {
+            "time": time.time(),
+            "rss_bytes": self.rss_bytes(),
+            "fds": self.fd_count(),
+            "threads": threading.active_count(),
+        }
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            if self.__baseline is None:
+                self.__baseline = snapshot
+            stats = snapshot.compare_to(self.__baseline, "lineno")[:self.__top_allocators]
+            sample["allocators"] = [
+                {"location": str(stat.traceback), "size_bytes": stat.size, "growth_bytes": stat.size_diff}
+                for stat in stats
+            ]
+        if self.first is None:
+            self.first = sample
+        self.last = sample
+        return sample
+
+    def growth(self) -> dict:
+        if self.first is None or self.last is None:
+            return {"rss_bytes": 0, "fds": 0, "threads": 0}
+        return {key: self.last[key] - self.first[key] for key in ("rss_bytes", "fds", "threads")}
+
+    def run(self) -> None:
+        logger.info("sampling resources every {}s".format(self.__interval))
+        while True:
+            try:
+                sample = self.sample()
+                logger.info("resources: rss={}KiB fds={} threads={} growth={}".format(
+                    sample["rss_bytes"] // 1024, sample["fds"], sample["threads"], self.growth()
+                ))
+                for allocator in sample.get("allocators", ()):
+                    logger.debug("allocator {location}: {size_bytes}B ({growth_bytes:+}B)".format(**allocator))
+                metrics = collect_metrics()
+                if metrics:
+                    logger.info("metrics: {}".format(json.dumps(metrics)))
+            except Exception as ex:
+                logger.error("sampling resources failed - {}".format(ex))
+            time.sleep(self.__interval)
@@ -0,0 +1,133 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("HTTPAPI", )
+
+
+from .logger import get_logger
+from .config import conf
+from .diagnostics import collect_metrics
+from .command_queue import ERROR_BUSY, ERROR_UNKNOWN, ERROR_REJECTED, ERROR_FAILED
+import http.server
+import json
+import os
+import socketserver
+import threading
+import typing
+import urllib.parse
+import uuid
+
+
+logger = get_logger(__name__.split(".", 1)[-1])
+
+error_status = {
+    ERROR_BUSY: 503,
+    ERROR_UNKNOWN: 404,
+    ERROR_REJECTED: 422,
+    ERROR_FAILED: 502,
+}
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        super().server_bind()
+
+
+class HTTPAPI(threading.Thread):
+    def __init__(self, registry_callback: typing.Callable, command_callback: typing.Callable):
+        super().__init__(name="http-api", daemon=True)
+        self.__registry_callback = registry_callback
+        self.__command_callback = command_callback
+
+    def devices(self) -> typing.List[dict]:
+        return self.__registry_callback()
+
+    def execute(self, device_id: str, service: str, data: str) -> typing.Tuple[int, dict]:
+        if not any(device["id"] == device_id and device["state"] == "online" for device in self.devices()):
+            return 404, {"error": "device unknown or offline"}
+        done = threading.Event()
+        outcome = dict()
+
+        def reply(result: typing.Optional[dict], error: typing.Optional[str], kind: str = ERROR_FAILED):
+            outcome["result"] = result
+            outcome["error"] = error
+            outcome["kind"] = kind
+            done.set()
+
+        payload = json.dumps({"command_id": str(uuid.uuid4()), "data": data})
+        self.__command_callback(device_id, service, payload, reply=reply)
+        if not done.wait(conf.HTTP.timeout_seconds):
+            return 504, {"error": "command timed out"}
+        if outcome["error"] is not None:
+            return error_status.get(outcome["kind"], 502), {"error": outcome["error"]}
+        return 200, outcome["result"]
+
+    def __handler(self):
+        api = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def __respond(self, status: int, body: typing.Any):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def __path(self) -> typing.List[str]:
+                return [urllib.parse.unquote(part) for part in urllib.parse.urlsplit(self.path).path.split("/") if part]
+
+            def do_GET(self):
+                path = self.__path()
+                if path == ["devices"]:
+                    self.__respond(200, api.devices())
+                elif path == ["metrics"]:
+                    self.__respond(200, collect_metrics())
+                else:
+                    self.__respond(404, {"error": "not found"})
+
+            def do_POST(self):
+                path = self.__path()
+                if len(path) != 3 or path[0] != "devices":
+                    self.__respond(404, {"error": "not found"})
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                data = self.rfile.read(length).decode() if length else ""
+                try:
+                    if data:
+                        json.loads(data)
+                except ValueError:
+                    self.__respond(400, {"error": "invalid json"})
+                    return
+                self.__respond(*api.execute(path[1], path[2], data))
+
+            def log_message(self, format: str, *args):
+                logger.debug(format % args)
+
+        return Handler
+
+    def run(self) -> None:
+        if conf.HTTP.unix_socket:
+            server = UnixHTTPServer(conf.HTTP.unix_socket, self.__handler())
+            logger.info("serving on '{}'".format(conf.HTTP.unix_socket))
+        else:
+            server = http.server.ThreadingHTTPServer((conf.HTTP.host, conf.HTTP.port), self.__handler())
+            logger.info("serving on '{}:{}'".format(conf.HTTP.host, conf.HTTP.port))
+        server.serve_forever()
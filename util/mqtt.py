@@ -19,8 +19,12 @@ __all__ = ("MQTTClient", )
 
 from .logger import get_logger
 from .config import conf
+from . import diagnostics
+import collections
 import paho.mqtt.client
+import threading
 import time
+import typing
 import mgw_dc
 
 
@@ -36,17 +40,33 @@ class MQTTClient:
         self.__client.on_connect = self.__on_connect
         self.__client.on_disconnect = self.__on_disconnect
         self.__client.on_message = self.__on_message
+        self.__client.on_publish = self.__on_publish
         self.__client.will_set(topic=mgw_dc.dm.gen_last_will_topic(conf.Client.id), payload="1", qos=2)
+        self.__client.max_inflight_messages_set(conf.Publish.inflight_window)
         if conf.Logger.enable_mqtt:
             self.__client.enable_logger(logger)
         self.connected = self.__client.is_connected
         self.on_connect = None
         self.on_message = None
+        self.__outbound = collections.deque()
+        self.__inflight = dict()
+        self.__acknowledged = set()
+        self.__publishing = False
+        self.__condition = threading.Condition()
+        self.__stats = {"published": 0, "dropped": 0, "latency_total": 0.0, "latency_max": 0.0}
+        self.__qos = {"response": conf.Publish.qos_response, "device": conf.Publish.qos_device}
+        diagnostics.register_metrics("publish", self.metrics)
 
     def __on_connect(self, client, userdata, flags, rc):
         if rc == 0:
             logger.info("connected to '{}'".format(conf.MsgBroker.host))
             self.__client.subscribe(mgw_dc.dm.gen_refresh_topic(), 1)
+            self.__client.subscribe(mgw_dc.com.gen_command_topic("+"), 1)
+            with self.__condition:
+                # paho retransmits unacknowledged messages itself, they must not block the window forever
+                self.__inflight.clear()
+                self.__acknowledged.clear()
+                self.__condition.notify_all()
             self.on_connect()
         else:
             logger.error("could not connect to '{}' - {}".format(conf.MsgBroker.host, paho.mqtt.client.connack_string(rc)))
@@ -60,7 +80,54 @@ class MQTTClient:
     def __on_message(self, client, userdata, message: paho.mqtt.client.MQTTMessage):
         self.on_message(message.topic, message.payload)
 
+    def __on_publish(self, client, userdata, mid):
+        with self.__condition:
+            enqueued = self.__inflight.pop(mid, None)
+            if enqueued is None:
+                # only the publish in progress can be acknowledged before its id is known, any other unknown id
+                # belongs to a message re-sent after a reconnect and would match a later publish reusing it
+                if self.__publishing:
+                    self.__acknowledged.add(mid)
+            else:
+                self.__record_published(enqueued)
+            self.__condition.notify_all()
+
+    def __record_published(self, enqueued: float):
+        latency = time.monotonic() - enqueued
+        self.__stats["published"] += 1
+        self.__stats["latency_total"] += latency
+        self.__stats["latency_max"] = max(self.__stats["latency_max"], latency)
+
+    def __drain(self):
+        while True:
+            with self.__condition:
+                while not (self.__outbound and self.__client.is_connected()
+                           and len(self.__inflight) < conf.Publish.inflight_window):
+                    self.__condition.wait(1)
+                enqueued, topic, payload, qos = self.__outbound.popleft()
+                self.__publishing = True
+            # paho calls on_publish while holding its own locks, so publishing must happen outside of ours
+            msg_info = self.__client.publish(topic=topic, payload=payload, qos=qos, retain=False)
+            with self.__condition:
+                self.__publishing = False
+                acknowledged = msg_info.mid in self.__acknowledged
+                self.__acknowledged.clear()
+                if msg_info.rc == paho.mqtt.client.MQTT_ERR_SUCCESS or (
+                        msg_info.rc == paho.mqtt.client.MQTT_ERR_NO_CONN and qos > 0):
+                    logger.debug("published '{}' - (q{}, m{})".format(payload, qos, msg_info.mid))
+                    if qos == 0 or acknowledged:
+                        self.__record_published(enqueued)
+                    else:
+                        self.__inflight[msg_info.mid] = enqueued
+                else:
+                    logger.warning("publishing to '{}' failed - {}".format(
+                        topic, paho.mqtt.client.error_string(msg_info.rc).replace(".", "").lower()
+                    ))
+                    self.__outbound.appendleft((enqueued, topic, payload, qos))
+                    self.__condition.wait(1)
+
     def start(self):
+        threading.Thread(target=self.__drain, name="mqtt-publish", daemon=True).start()
         while True:
             try:
                 self.__client.connect(conf.MsgBroker.host, conf.MsgBroker.port, keepalive=conf.Client.keep_alive)
@@ -86,9 +153,24 @@ class MQTTClient:
         else:
             raise RuntimeError(paho.mqtt.client.error_string(res[0]).replace(".", "").lower())
 
-    def publish(self, topic: str, payload: str, qos: int) -> None:
-        msg_info = self.__client.publish(topic=topic, payload=payload, qos=qos, retain=False)
-        if msg_info.rc == paho.mqtt.client.MQTT_ERR_SUCCESS:
-            logger.debug("published '{}' - (q{}, m{})".format(payload, qos, msg_info.mid))
-        else:
-            raise RuntimeError(paho.mqtt.client.error_string(msg_info.rc).replace(".", "").lower())
+    def publish(self, topic: str, payload: str, qos: int, msg_class: typing.Optional[str] = None) -> None:
+        qos = self.__qos.get(msg_class, qos)
+        with self.__condition:
+            if len(self.__outbound) >= conf.Publish.queue_size:
+                dropped = self.__outbound.popleft()
+                self.__stats["dropped"] += 1
+                logger.warning("outbound queue full, dropping message for '{}'".format(dropped[1]))
+            self.__outbound.append((time.monotonic(), topic, payload, qos))
+            self.__condition.notify_all()
+
+    def metrics(self) -> dict:
+        with self.__condition:
+            published = self.__stats["published"]
+            return {
+                "queue_depth": len(self.__outbound),
+                "inflight": len(self.__inflight),
+                "published": published,
+                "dropped": self.__stats["dropped"],
+                "latency_avg_seconds": self.__stats["latency_total"] / published if published else 0.0,
+                "latency_max_seconds": self.__stats["latency_max"],
+            }
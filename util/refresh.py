@@ -0,0 +1,56 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("RefreshCoordinator", )
+
+
+from .logger import get_logger
+from .config import conf
+from . import diagnostics
+import threading
+import time
+import typing
+
+
+logger = get_logger(__name__.split(".", 1)[-1])
+
+
+class RefreshCoordinator(threading.Thread):
+    def __init__(self, refresh_callback: typing.Callable):
+        super().__init__(name="refresh", daemon=True)
+        self.__refresh_callback = refresh_callback
+        self.__requested = threading.Event()
+        self.__stats = {"triggers": 0, "refreshes": 0}
+        diagnostics.register_metrics("refresh", self.metrics)
+
+    def trigger(self):
+        self.__stats["triggers"] += 1
+        self.__requested.set()
+
+    def run(self) -> None:
+        while True:
+            self.__requested.wait()
+            # triggers arriving within the window are served by the same refresh
+            time.sleep(conf.Refresh.debounce_seconds)
+            self.__requested.clear()
+            self.__stats["refreshes"] += 1
+            try:
+                self.__refresh_callback()
+            except Exception as ex:
+                logger.error("refresh failed - {}".format(ex))
+
+    def metrics(self) -> dict:
+        return dict(self.__stats, merged=self.__stats["triggers"] - self.__stats["refreshes"])
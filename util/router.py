@@ -19,6 +19,9 @@ __all__ = ("Router", )
 
 
 from .logger import get_logger
+from .config import conf
+from .command_queue import ERROR_UNKNOWN, ERROR_REJECTED
+import threading
 import typing
 import mgw_dc
 
@@ -27,16 +30,46 @@ logger = get_logger(__name__.split(".", 1)[-1])
 
 
 class Router:
-    def __init__(self, refresh_callback: typing.Callable, command_callback: typing.Callable):
+    def __init__(self, refresh_callback: typing.Callable, command_callback: typing.Callable,
+                 reject_callback: typing.Callable, services: typing.Iterable[str]):
         self.__refresh_callback = refresh_callback
         self.__command_callback = command_callback
+        self.__reject_callback = reject_callback
+        self.__services = tuple(services)
+        self.__refresh_topic = mgw_dc.dm.gen_refresh_topic()
+        self.__topics: typing.Dict[str, typing.Tuple[str, str]] = dict()
+        self.__device_topics: typing.Dict[str, typing.Tuple[str, ...]] = dict()
+        self.__lock = threading.Lock()
+
+    def add_device(self, device_id: str):
+        topics = {mgw_dc.com.gen_command_topic(device_id, service): (device_id, service) for service in self.__services}
+        with self.__lock:
+            self.__device_topics[device_id] = tuple(topics)
+            self.__topics.update(topics)
+        logger.debug("routing commands for '{}'".format(device_id))
+
+    def remove_device(self, device_id: str):
+        with self.__lock:
+            for topic in self.__device_topics.pop(device_id, ()):
+                self.__topics.pop(topic, None)
+        logger.debug("stopped routing commands for '{}'".format(device_id))
 
     def route(self, topic: str, payload: typing.AnyStr):
         try:
-            if topic == mgw_dc.dm.gen_refresh_topic():
+            if topic == self.__refresh_topic:
                 self.__refresh_callback()
+                return
+            target = self.__topics.get(topic)
+            if target:
+                self.__command_callback(target[0], target[1], payload)
+                return
+            device_id, service = mgw_dc.com.parse_command_topic(topic)
+            # commands for devices of other connectors arrive through the wildcard subscription as well
+            if not device_id.startswith(conf.Discovery.device_id_prefix):
+                return
+            if device_id in self.__device_topics:
+                self.__reject_callback(device_id, service, payload, "unsupported service", kind=ERROR_REJECTED)
             else:
-                device_id, service = mgw_dc.com.parse_command_topic(topic)
-                self.__command_callback(device_id, service, payload)
+                self.__reject_callback(device_id, service, payload, "device unknown or offline", kind=ERROR_UNKNOWN)
         except Exception as ex:
             logger.error("can't route message - {}\n{}: {}".format(ex, topic, payload))
@@ -0,0 +1,107 @@
+"""
+   Copyright 2021 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import contextlib
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from util import get_logger
+from util.diagnostics import register_metrics
+
+logger = get_logger(__name__.split(".", 1)[-1])
+
+INTERACTIVE = 0
+BACKGROUND = 1
+DISCOVERY = 2
+
+priority_names = {
+    INTERACTIVE: "interactive",
+    BACKGROUND: "background",
+    DISCOVERY: "discovery",
+}
+
+
+# exclusive use of one adapter, granted to the highest waiting priority class first
+class WorkScheduler:
+    def __init__(self, adapter: str):
+        self.adapter = adapter
+        self.__condition = threading.Condition()
+        self.__holder: Optional[int] = None
+        self.__holder_preempt: Optional[Callable] = None
+        self.__waiting = {priority: 0 for priority in priority_names}
+        self.__stats = {priority: {"count": 0, "wait_total": 0.0, "wait_max": 0.0, "preemptions": 0}
+                        for priority in priority_names}
+
+    def __blocked(self, priority: int) -> bool:
+        if self.__holder is not None:
+            return True
+        return any(self.__waiting[other] for other in priority_names if other < priority)
+
+    def should_yield(self, priority: int) -> bool:
+        return any(self.__waiting[other] for other in priority_names if other < priority)
+
+    @contextlib.contextmanager
+    def acquire(self, priority: int, preempt: Optional[Callable] = None):
+        started = time.monotonic()
+        with self.__condition:
+            self.__waiting[priority] += 1
+            if self.__holder is not None and priority < self.__holder and self.__holder_preempt:
+                logger.debug("{} work preempts {} work on {}".format(
+                    priority_names[priority], priority_names[self.__holder], self.adapter))
+                self.__stats[self.__holder]["preemptions"] += 1
+                self.__holder_preempt()
+                self.__holder_preempt = None
+            while self.__blocked(priority):
+                self.__condition.wait()
+            self.__waiting[priority] -= 1
+            self.__holder = priority
+            self.__holder_preempt = preempt
+            waited = time.monotonic() - started
+            stats = self.__stats[priority]
+            stats["count"] += 1
+            stats["wait_total"] += waited
+            stats["wait_max"] = max(stats["wait_max"], waited)
+        try:
+            yield
+        finally:
+            with self.__condition:
+                self.__holder = None
+                self.__holder_preempt = None
+                self.__condition.notify_all()
+
+    def metrics(self) -> dict:
+        with self.__condition:
+            return {
+                priority_names[priority]: {
+                    "count": stats["count"],
+                    "waiting": self.__waiting[priority],
+                    "wait_avg_seconds": stats["wait_total"] / stats["count"] if stats["count"] else 0.0,
+                    "wait_max_seconds": stats["wait_max"],
+                    "preemptions": stats["preemptions"],
+                } for priority, stats in self.__stats.items()
+            }
+
+
+_schedulers: Dict[str, WorkScheduler] = dict()
+_schedulers_lock = threading.Lock()
+
+
+def get_work_scheduler(adapter: str) -> WorkScheduler:
+    with _schedulers_lock:
+        if adapter not in _schedulers:
+            _schedulers[adapter] = WorkScheduler(adapter)
+            register_metrics("scheduler_" + adapter, _schedulers[adapter].metrics)
+        return _schedulers[adapter]